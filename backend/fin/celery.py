@@ -17,17 +17,23 @@ app = Celery("fin")
 app.config_from_object("django.conf:settings")
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# stamp & measure queue wait of every task
+from fin import queue_metrics  # noqa: E402,F401
 
 # define exchanges
 default_exchange = Exchange("default", type="direct")
 stock_exchange = Exchange("stock", type="direct")
 news_exchange = Exchange("news", type="direct")
+interactive_exchange = Exchange("interactive", type="direct")
 
 # defind queues
 app.conf.task_queues = (
     Queue("default", default_exchange, routing_key="default"),
     Queue("stock", stock_exchange, routing_key="stock"),
     Queue("news", news_exchange, routing_key="news"),
+    # refreshes a user is waiting for, served by workers of their own
+    # so they don't queue up behind sweeps
+    Queue("interactive", interactive_exchange, routing_key="interactive"),
 )
 
 app.conf.task_default_queue = "default"
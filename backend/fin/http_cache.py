@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of Yahoo responses.
+
+Statements change a few times a year, yet we used to download all of
+them every night. W/ `settings.HTTP_CACHE_DIR` set, a Yahoo response
+is kept on disk, and is served from there for as long as its kind of
+data stays fresh, see `settings.HTTP_CACHE_TTL`. Entries are laid
+out the same way as fixtures, see `fin.http_fixtures.fixture_path`,
+but keyed on the day a date range starts. Otherwise a short
+incremental price download could be served for a full backfill of
+the same symbol. The end of a range is always "now", so it's left
+out, as fixtures do. Entries gone stale are removed every once in a
+while, see `prune`.
+
+Besides, workers remember the content hash of what they have last
+persisted per symbol. When a payload, cached or freshly downloaded,
+hashes the same, there is nothing new, so they skip parsing & DB
+writes altogether.
+
+`PlainUtility` and `stock.workers.batch.YahooTransport`, which
+yahooquery requests go through, call `lookup` and `store`.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from django.conf import settings
+
+from fin.http_fixtures import YAHOO_HOSTS
+from fin.http_fixtures import fixture_path
+
+logger = logging.getLogger("stock")
+
+# query parameters left out of an entry's key
+VOLATILE = ["crumb", "period2"]
+
+# start of a date range, in seconds since epoch, rounded down to its
+# day in an entry's key
+PERIOD_START = "period1"
+DAY = 24 * 3600
+
+# seconds between two prunes of a process
+PRUNE_INTERVAL = 3600
+
+# when this process last pruned
+_pruned = 0
+
+# kind of data: path of its Yahoo endpoint
+KINDS = {
+    "prices": "/v7/finance/download/",
+    "statements": "/ws/fundamentals-timeseries/",
+    "summary": "/v10/finance/quoteSummary/",
+}
+
+
+def _kind(path):
+    for kind, prefix in KINDS.items():
+        if path.startswith(prefix):
+            return kind
+    return None
+
+
+def _key_param(name, val):
+    if name == PERIOD_START and val.isdigit():
+        return name, str(int(val) // DAY * DAY)
+    return name, val
+
+
+def _entry_path(url):
+    """Where a url's cache entry is, or None if url isn't cached."""
+    if not settings.HTTP_CACHE_DIR:
+        return None
+
+    parts = urlparse(url)
+    if parts.netloc not in YAHOO_HOSTS or not _kind(parts.path):
+        return None
+
+    return fixture_path(
+        settings.HTTP_CACHE_DIR,
+        parts.netloc,
+        parts.path,
+        urlencode([_key_param(k, v) for k, v in parse_qsl(parts.query)]),
+        volatile=VOLATILE,
+    )
+
+
+def lookup(url):
+    """Cached response of url if it's still fresh, or None."""
+    path = _entry_path(url)
+    if path is None:
+        return None
+
+    ttl = settings.HTTP_CACHE_TTL.get(_kind(urlparse(url).path), 0)
+    try:
+        if time.time() - os.stat(path).st_mtime > ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def store(url, status, content_type, body):
+    """Cache a good response."""
+    path = _entry_path(url)
+    if path is None or status != 200:
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(
+            {
+                "url": url,
+                "status": status,
+                "content_type": content_type,
+                "body": body,
+            },
+            f,
+        )
+    os.replace(tmp, path)
+
+    global _pruned
+    if time.time() - _pruned > PRUNE_INTERVAL:
+        _pruned = time.time()
+        prune()
+
+
+def prune():
+    """Remove entries older than their kind's TTL.
+
+    They will never be served again, see `lookup`, and prices are
+    cached under a new key every day.
+
+    Return
+    ------
+      int: number of entries removed.
+    """
+    if not settings.HTTP_CACHE_DIR:
+        return 0
+
+    now = time.time()
+    removed = 0
+    for host in YAHOO_HOSTS:
+        root = os.path.join(settings.HTTP_CACHE_DIR, host)
+        for dirpath, _, names in os.walk(root):
+            kind = _kind("/{}/".format(os.path.relpath(dirpath, root)))
+            ttl = settings.HTTP_CACHE_TTL.get(kind, 0)
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    if now - os.stat(path).st_mtime > ttl:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    # pruned by another process
+                    pass
+
+    logger.debug("pruned {} cache entries".format(removed))
+    return removed
+
+
+def digest(payload):
+    """Content hash of a str or bytes payload."""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()
+
+
+def _persisted_path(kind, symbol):
+    return os.path.join(settings.HTTP_CACHE_DIR, "persisted", kind, symbol)
+
+
+def is_persisted(kind, symbol, content_hash):
+    """True if we have persisted this very content of a symbol."""
+    if not settings.HTTP_CACHE_DIR:
+        return False
+
+    try:
+        with open(_persisted_path(kind, symbol)) as f:
+            return f.read() == content_hash
+    except FileNotFoundError:
+        return False
+
+
+def mark_persisted(kind, symbol, content_hash):
+    if not settings.HTTP_CACHE_DIR:
+        return
+
+    path = _persisted_path(kind, symbol)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content_hash)
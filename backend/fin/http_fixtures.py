@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Record Yahoo responses, and replay them from a local stand-in.
+
+W/ `settings.HTTP_RECORD_DIR` set, every Yahoo response we read is
+saved as a fixture, one JSON file per request:
+
+  <dir>/<host><path>/<query hash>.json
+
+Query parameters that change every run, eg. the date range of a
+price download, are left out of the hash, so a recording replays
+for any date range.
+
+W/ `settings.YAHOO_STANDIN` set, eg. "http://localhost:8899", Yahoo
+requests are sent there instead, w/ the original host as the first
+path segment. `manage.py yahoo_standin` serves the recorded fixtures
+w/ configurable latency and throttling, so we can load test
+ingestion offline and reproducibly.
+
+`PlainUtility` and `stock.workers.batch.YahooTransport`, which
+yahooquery requests go through, call `standin_url` and `record`.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from django.conf import settings
+
+logger = logging.getLogger("stock")
+
+YAHOO_HOSTS = ["query1.finance.yahoo.com", "query2.finance.yahoo.com"]
+
+# query parameters left out of a fixture's key
+VOLATILE = ["crumb", "period1", "period2"]
+
+
+def fixture_path(root, host, path, query, volatile=VOLATILE):
+    """Where the fixture of a request is.
+
+    Args
+    ----
+      :param: root, str, fixture dir
+      :param: host, str, eg. "query1.finance.yahoo.com"
+      :param: path, str, eg. "/v7/finance/download/AAPL"
+      :param: query, str, url query string
+      :param: volatile, list of str, query parameters left out of key
+    """
+    params = sorted((k, v) for k, v in parse_qsl(query) if k not in volatile)
+    key = hashlib.sha1(urlencode(params).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(root, host, path.strip("/"), "{}.json".format(key))
+
+
+def standin_url(url):
+    """Point a Yahoo url to the stand-in, if there's one."""
+    if not settings.YAHOO_STANDIN:
+        return url
+
+    parts = urlparse(url)
+    if parts.netloc not in YAHOO_HOSTS:
+        return url
+
+    return "{}/{}{}{}".format(
+        settings.YAHOO_STANDIN.rstrip("/"),
+        parts.netloc,
+        parts.path,
+        "?" + parts.query if parts.query else "",
+    )
+
+
+def record(url, status, content_type, body):
+    """Save a response as fixture, if we are recording.
+
+    Responses replayed from a stand-in are not recorded again.
+    """
+    if not settings.HTTP_RECORD_DIR or settings.YAHOO_STANDIN:
+        return
+
+    parts = urlparse(url)
+    if parts.netloc not in YAHOO_HOSTS:
+        return
+
+    path = fixture_path(
+        settings.HTTP_RECORD_DIR, parts.netloc, parts.path, parts.query
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "url": url,
+                "status": status,
+                "content_type": content_type,
+                "body": body,
+            },
+            f,
+        )
+    logger.debug("recorded {}".format(path))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""How long tasks wait in their queue.
+
+Every task message is stamped w/ the time it's published. When a
+worker picks it up, we know how long it has waited, and once it's
+done, how long it took end to end, eg. from a user adding a stock to
+its prices being in. Both are logged, and the last `WINDOW` of them
+are kept in redis per queue. `manage.py queue_wait` reports them.
+
+W/o redis, they are only logged.
+
+"""
+
+import logging
+import time
+
+import redis
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+
+logger = logging.getLogger("stock")
+
+# samples kept per queue & metric
+WINDOW = 1000
+
+METRICS = ["wait", "total"]
+
+_client = None
+
+
+def _redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis(host=settings.REDIS_HOST, port=6379, db=0)
+    return _client
+
+
+def _key(queue, metric):
+    return "queuewait:{}:{}".format(queue, metric)
+
+
+def record(queue, metric, seconds):
+    if not settings.REDIS_HOST:
+        return
+
+    key = _key(queue, metric)
+    try:
+        pipe = _redis().pipeline()
+        pipe.lpush(key, round(seconds, 3))
+        pipe.ltrim(key, 0, WINDOW - 1)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception("failed to record {}".format(key))
+
+
+def samples(queue, metric):
+    """Recorded seconds of a queue's metric, latest first."""
+    return [float(x) for x in _redis().lrange(_key(queue, metric), 0, -1)]
+
+
+def queues():
+    """Queues that have samples."""
+    names = set()
+    for key in _redis().scan_iter(match=_key("*", "*")):
+        names.add(key.decode("utf-8").split(":")[1])
+    return sorted(names)
+
+
+def _queue(task):
+    return (task.request.delivery_info or {}).get("routing_key", "unknown")
+
+
+@before_task_publish.connect
+def stamp(headers=None, **kwargs):
+    # protocol 1 has no headers, then we don't measure
+    if headers is not None:
+        headers["published"] = time.time()
+
+
+@task_prerun.connect
+def on_prerun(task=None, **kwargs):
+    published = getattr(task.request, "published", None)
+    if published is None:
+        return
+
+    wait = time.time() - published
+    logger.debug(
+        "{} waited {:.1f}s in {}".format(task.name, wait, _queue(task))
+    )
+    record(_queue(task), "wait", wait)
+
+
+@task_postrun.connect
+def on_postrun(task=None, **kwargs):
+    published = getattr(task.request, "published", None)
+    if published is None:
+        return
+
+    record(_queue(task), "total", time.time() - published)
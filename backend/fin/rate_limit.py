@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Token buckets shared by all processes, one per upstream host.
+
+Celery's `rate_limit` is per worker process, so the more workers we
+run the harder we hit Yahoo. Instead, every request first takes a
+token from its host's bucket in redis, thus the aggregate rate is
+what `settings.RATE_LIMITS` says no matter how many workers there
+are.
+
+Taking a token is a reservation: a bucket may go negative, and the
+caller sleeps until its token would have been refilled. Thus every
+caller is served in order w/ one round trip to redis.
+
+W/o redis, eg. running locally, each process keeps its own buckets.
+
+"""
+
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger("stock")
+
+# KEYS[1]: bucket
+# ARGV: rate (tokens/second), capacity, tokens to take
+# Return: seconds to wait, as a string because redis truncates numbers
+TAKE = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+tokens = tokens - requested
+
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate) + 60)
+
+if tokens >= 0 then
+    return "0"
+end
+return tostring(-tokens / rate)
+"""
+
+_client = None
+_take = None
+
+# in-process buckets: {host: (tokens, ts)}
+_local = {}
+_local_lock = threading.Lock()
+
+
+def _redis_take(key, rate, capacity, tokens):
+    global _client, _take
+    if _client is None:
+        _client = redis.Redis(host=settings.REDIS_HOST, port=6379, db=0)
+        _take = _client.register_script(TAKE)
+
+    wait = _take(
+        keys=["ratelimit:{}".format(key)], args=[rate, capacity, tokens]
+    )
+    return float(wait)
+
+
+def _local_take(key, rate, capacity, tokens):
+    with _local_lock:
+        now = time.monotonic()
+        available, ts = _local.get(key, (capacity, now))
+        available = min(capacity, available + (now - ts) * rate) - tokens
+        _local[key] = (available, now)
+
+    if available >= 0:
+        return 0
+    return -available / rate
+
+
+def acquire(key, tokens=1):
+    """Block until `tokens` requests to `key` are allowed.
+
+    Args
+    ----
+      :param: key, str, upstream host, eg. "query2.finance.yahoo.com"
+      :param: tokens, int, number of requests about to make
+    """
+    limit = settings.RATE_LIMITS.get(key)
+    if not limit or not tokens:
+        return
+
+    per_minute, capacity = limit
+    rate = per_minute / 60.0
+
+    wait = None
+    if settings.REDIS_HOST:
+        try:
+            wait = _redis_take(key, rate, capacity, tokens)
+        except redis.RedisError:
+            logger.exception("rate limit falls back to this process")
+
+    if wait is None:
+        wait = _local_take(key, rate, capacity, tokens)
+
+    if wait > 0:
+        logger.debug("{}: wait {:.1f}s for {} tokens".format(key, wait, tokens))
+        time.sleep(wait)
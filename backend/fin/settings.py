@@ -184,6 +184,51 @@ elif DEPLOY_TYPE == "production":
 
     # STATICFILES_STORAGE = 'storages.backends.s3boto.S3BotoStorage'
 
+# Memory-mapped price cache shared by web and celery, see
+# `stock.price_cache`
+PRICE_CACHE_DIR = os.environ.get(
+    "PRICE_CACHE_DIR", os.path.join(BASE_DIR, "price_cache")
+)
+
+# Aggregate request rate to upstream hosts, shared by all web and
+# celery processes, see `fin.rate_limit`. {host: (requests per
+# minute, burst)}. Hosts not listed here are not limited.
+RATE_LIMITS = {
+    "query1.finance.yahoo.com": (60, 5),
+    "query2.finance.yahoo.com": (60, 5),
+}
+
+# Keep-alive connections per upstream host, per process
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+
+# Record Yahoo responses as fixtures under this dir, and/or send
+# Yahoo requests to a local stand-in serving them, eg.
+# "http://localhost:8899". See `fin.http_fixtures`.
+HTTP_RECORD_DIR = os.environ.get("HTTP_RECORD_DIR")
+YAHOO_STANDIN = os.environ.get("YAHOO_STANDIN")
+
+# On-disk cache of Yahoo responses, see `fin.http_cache`. Set it
+# empty to disable.
+HTTP_CACHE_DIR = os.environ.get(
+    "HTTP_CACHE_DIR", os.path.join(BASE_DIR, "http_cache")
+)
+
+# Seconds a cached response stays fresh, by kind of data
+HTTP_CACHE_TTL = {
+    "prices": 5 * 60,
+    "statements": 2 * 24 * 3600,
+    "summary": 6 * 3600,
+}
+
+# Seconds a user requested refresh of a symbol covers, by kind of
+# data. Requests of the same symbol & kind within it attach to the
+# refresh in flight, or are skipped once it's done. See
+# `stock.refresh`.
+REFRESH_TTL = {
+    "prices": 15 * 60,
+    "statements": 24 * 3600,
+}
+
 # Celery redis
 # CELERY SETTINGS
 BROKER_URL = "redis://%s:6379/0" % REDIS_HOST
@@ -2,36 +2,101 @@
 from __future__ import absolute_import
 
 import logging
+from urllib.parse import urlparse
 
+from django.conf import settings
 from selenium import webdriver
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from urllib3 import PoolManager
 from urllib3 import Retry
 from urllib3 import Timeout
 
+from fin import http_cache
+from fin import http_fixtures
+from fin.rate_limit import acquire
+
 logger = logging.getLogger("jk")
 
+# shared by tasks of this process, see `get_agent`
+_agent = None
+
 
 class PlainUtility:
-    def __init__(self):
+    def __init__(self, pool_size=None):
         user_agent = "Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.7) Gecko/2009021910 Firefox/3.0.7"
         self.headers = {"User-Agent": user_agent}
         self.ip_url = "http://icanhazip.com/"
         retries = Retry(connect=5, read=25, redirect=5)
+
+        # up to `pool_size` keep-alive connections per host
         self.agent = PoolManager(
-            10, retries=retries, timeout=Timeout(total=30.0)
+            10,
+            maxsize=pool_size or settings.HTTP_POOL_SIZE,
+            retries=retries,
+            timeout=Timeout(total=30.0),
         )
 
     def current_ip(self):
         return self.request(self.ip_url)
 
     def request(self, url):
-        r = self.agent.request("GET", url)
+        cached = http_cache.lookup(url)
+        if cached:
+            return cached["body"]
+
+        # wait for my turn, shared w/ other workers
+        acquire(urlparse(url).netloc)
+
+        r = self.agent.request("GET", http_fixtures.standin_url(url))
         if r.status == 200:
-            return r.data.decode("utf-8")
+            content = r.data.decode("utf-8")
+            content_type = r.headers.get("Content-Type")
+            http_fixtures.record(url, r.status, content_type, content)
+            http_cache.store(url, r.status, content_type, content)
+            return content
         else:
             logger.error("status %s" % r.status)
 
+    def pool_stats(self):
+        return pool_stats(self.agent)
+
+
+def pool_stats(manager):
+    """Connection reuse of a urllib3 PoolManager.
+
+    Return
+    ------
+      dict: {host: {"requests", "connections", "reuse"}}, where
+      `connections` is how many new connections were made, and
+      `reuse` is % of requests made on an existing one.
+    """
+    stats = {}
+    for key in list(manager.pools.keys()):
+        pool = manager.pools.get(key)
+        if pool is None or not pool.num_requests:
+            continue
+
+        reused = max(0, pool.num_requests - pool.num_connections)
+        stats[pool.host] = {
+            "requests": pool.num_requests,
+            "connections": pool.num_connections,
+            "reuse": reused / pool.num_requests * 100,
+        }
+    return stats
+
+
+def get_agent():
+    """PlainUtility shared by all tasks of this process.
+
+    So tasks reuse keep-alive connections instead of paying TCP+TLS
+    setup every time. It's created when a celery worker process
+    starts, or on first use.
+    """
+    global _agent
+    if _agent is None:
+        _agent = PlainUtility()
+    return _agent
+
 
 class SeleniumUtility:
     def __init__(self, use_tor=True):
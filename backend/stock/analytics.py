@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""Batch analytics over a stock's price history.
+
+Per-bar indicators such as `last_lower` used to be computed w/ a
+couple queries per bar. Here we load a symbol's series once and
+compute the indicator for every bar in one pass over arrays.
+
+"""
+
+import bisect
+import logging
+import math
+
+import numpy as np
+
+from stock import price_cache
+from stock.models import MyStock, MyStockHistorical
+
+logger = logging.getLogger("stock")
+
+# MyStockHistorical fields that are materialized from the price series
+ANALYTICS = ["last_lower", "last_better", "next_better", "gain_probability"]
+
+# rows per UPDATE statement
+BATCH_SIZE = 1000
+
+
+def _days_since(closes, keep):
+    """Distance (in bars) to the previous close satisfying `keep`.
+
+    Using a monotonic stack of indexes: a bar is popped once a later
+    bar makes it useless, eg. looking for a lower close, any earlier
+    bar whose close >= mine will never be the answer for bars after
+    me because I'm both closer and at least as low. Thus every bar
+    is pushed & popped at most once, O(N).
+
+    Args
+    ----
+      :param: closes, list of float, ordered by date
+      :param: keep, callable(prev, me) -> bool
+
+      True if `prev` is the kind of close we are looking for.
+
+    Return
+    ------
+      np.array of int: 0 if no such close has been seen.
+
+    """
+    vals = np.zeros(len(closes), dtype=np.int64)
+    stack = []
+    for i, me in enumerate(closes):
+        while stack and not keep(closes[stack[-1]], me):
+            stack.pop()
+        if stack:
+            vals[i] = i - stack[-1]
+        stack.append(i)
+    return vals
+
+
+def days_since_lower(closes):
+    """For each bar, how many bars since we saw a close lower than it."""
+    closes = np.asarray(closes, dtype=float).tolist()
+    return _days_since(closes, lambda prev, me: prev < me)
+
+
+def days_since_higher(closes):
+    """For each bar, how many bars since we saw a close higher than it."""
+    closes = np.asarray(closes, dtype=float).tolist()
+    return _days_since(closes, lambda prev, me: prev > me)
+
+
+def bars_until_above(closes, thresholds):
+    """For each bar, how many bars until a later close > its threshold.
+
+    Walking the series backwards, we keep a stack of the bars ahead
+    that are higher than every bar before them, ie. the only bars
+    that can be the _first_ to exceed any threshold. Closes on the
+    stack are higher the deeper they are, so the answer is found by
+    a binary search. O(N log N) overall.
+
+    Return
+    ------
+      np.array of int: 0 if no later close is above the threshold.
+
+    """
+    closes = np.asarray(closes, dtype=float).tolist()
+    thresholds = np.asarray(thresholds, dtype=float).tolist()
+
+    vals = np.zeros(len(closes), dtype=np.int64)
+
+    # stack of indexes, and their negated closes in increasing order
+    stack = []
+    neg_closes = []
+    for i in range(len(closes) - 1, -1, -1):
+        # top-most, thus nearest, bar whose close > threshold
+        k = bisect.bisect_left(neg_closes, -thresholds[i]) - 1
+        if k >= 0:
+            vals[i] = stack[k] - i
+
+        # I'm ahead of the next bar. Bars ahead of me that aren't
+        # higher than me will never be the first to exceed.
+        while stack and closes[stack[-1]] <= closes[i]:
+            stack.pop()
+            neg_closes.pop()
+        stack.append(i)
+        neg_closes.append(-closes[i])
+    return vals
+
+
+class FenwickTree:
+    """Binary indexed tree of counts, 1-based."""
+
+    def __init__(self, size):
+        self.tree = [0] * (size + 1)
+
+    def add(self, i, val=1):
+        while i < len(self.tree):
+            self.tree[i] += val
+            i += i & -i
+
+    def prefix_sum(self, i):
+        """Sum of counts at 1..i."""
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+def gain_probability(opens, closes):
+    """For each bar, % of later closes that are above its open.
+
+    Walking the series backwards, a Fenwick tree keeps counts of
+    closes we have passed, ie. future closes of the current bar,
+    indexed by their rank among all closes. Counting closes above
+    an open is then a prefix sum, O(N log N) overall.
+
+    """
+    opens = np.asarray(opens, dtype=float)
+    closes = np.asarray(closes, dtype=float)
+
+    # rank compression: close i is at 1-based rank close_ranks[i], and
+    # there are open_ranks[i] distinct close values <= open i.
+    uniques = np.unique(closes)
+    close_ranks = (np.searchsorted(uniques, closes, side="left") + 1).tolist()
+    open_ranks = np.searchsorted(uniques, opens, side="right").tolist()
+
+    tree = FenwickTree(len(uniques))
+    vals = np.zeros(len(closes), dtype=float)
+    for i in range(len(closes) - 1, -1, -1):
+        total_days = len(closes) - 1 - i
+        if total_days:
+            gain_days = total_days - tree.prefix_sum(open_ranks[i])
+            vals[i] = gain_days / total_days * 100.0
+        tree.add(close_ranks[i])
+    return vals
+
+
+def gain_probability_by_symbol(symbol):
+    """Gain probability of every bar of a symbol.
+
+    Return
+    ------
+      dict: {date: %}
+
+    """
+    analytics = HistoricalAnalytics.for_stock(
+        MyStock.objects.get(symbol=symbol).id
+    )
+    return dict(zip(analytics.ons, analytics.gain_probability.tolist()))
+
+
+class HistoricalAnalytics:
+    """Per-bar analytics of one stock's full price history.
+
+    Values are computed over the _full_ history even if caller is
+    only interested in a date range, because "last time I saw a lower
+    price" may well be outside that range.
+
+    """
+
+    def __init__(self, ons, opens, closes):
+        self.ons = list(ons)
+        self.index = {on: i for i, on in enumerate(self.ons)}
+
+        self.last_lower = days_since_lower(closes)
+        self.last_better = days_since_higher(closes)
+        self.next_better = bars_until_above(closes, opens)
+        self.gain_probability = gain_probability(opens, closes)
+
+    @classmethod
+    def for_stock(cls, stock_id):
+        """Load a stock's price series from cache, or w/ one query."""
+        series = price_cache.open_series(stock_id)
+        if series is not None:
+            return cls(
+                series.dates(),
+                series.column("open_price"),
+                series.column("close_price"),
+            )
+
+        rows = (
+            MyStockHistorical.objects.filter(stock_id=stock_id)
+            .order_by("on")
+            .values_list("on", "open_price", "close_price")
+        )
+        if rows:
+            ons, opens, closes = zip(*rows)
+        else:
+            ons, opens, closes = [], [], []
+        return cls(ons, opens, closes)
+
+    def value(self, attr, on):
+        """Look up value of `attr` on date `on`.
+
+        Return
+        ------
+          None if we don't have a bar on that date.
+
+        """
+        i = self.index.get(on)
+        if i is None:
+            return None
+        return getattr(self, attr)[i].item()
+
+
+def _differs(stored, val):
+    if stored is None:
+        return True
+    return not math.isclose(stored, val, rel_tol=1e-9)
+
+
+def update_historical_analytics(stock_id):
+    """Materialize analytics columns of a stock's historicals.
+
+    Values are computed for the whole series, but only bars whose
+    stored values differ are written back. After new bars are
+    appended, these are the new bars themselves, plus older bars
+    whose forward looking values have changed, eg. a `next_better`
+    that was 0 but now sees a better close. Note that
+    `gain_probability` counts the future bars, so it changes on
+    every older bar whenever a new bar arrives.
+
+    Return
+    ------
+      int: number of bars updated.
+
+    """
+    rows = list(
+        MyStockHistorical.objects.filter(stock_id=stock_id)
+        .order_by("on")
+        .values_list("id", "on", "open_price", "close_price", *ANALYTICS)
+    )
+    if not rows:
+        return 0
+
+    ids, ons, opens, closes = list(zip(*rows))[:4]
+    analytics = HistoricalAnalytics(ons, opens, closes)
+
+    changed = []
+    for i, row in enumerate(rows):
+        vals = {attr: getattr(analytics, attr)[i].item() for attr in ANALYTICS}
+        stored = dict(zip(ANALYTICS, row[4:]))
+        if any(_differs(stored[attr], vals[attr]) for attr in ANALYTICS):
+            changed.append(MyStockHistorical(id=ids[i], **vals))
+
+    MyStockHistorical.objects.bulk_update(
+        changed, ANALYTICS, batch_size=BATCH_SIZE
+    )
+    logger.debug(
+        "[{}] updated analytics of {} bars".format(stock_id, len(changed))
+    )
+    return len(changed)
+
+
+# resampling intervals, daily bars are the default
+INTERVALS = ["1w", "1mo", "1q"]
+
+
+def period_starts(ons, interval):
+    """Index of the first bar of each period, bars ordered by date.
+
+    Weeks start on Monday. Since 1970-01-01 was a Thursday, shifting
+    days since epoch by 3 makes Monday the boundary.
+
+    """
+    ons = np.asarray(ons, dtype="datetime64[D]")
+    if interval == "1w":
+        keys = (ons.astype(np.int64) + 3) // 7
+    elif interval == "1mo":
+        keys = ons.astype("datetime64[M]").astype(np.int64)
+    elif interval == "1q":
+        keys = ons.astype("datetime64[M]").astype(np.int64) // 3
+    else:
+        raise ValueError("Unknown interval: {}".format(interval))
+
+    if not keys.size:
+        return keys
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def resample_ohlcv(ons, opens, highs, lows, closes, vols, interval):
+    """Aggregate daily bars into bars of `interval`.
+
+    Return
+    ------
+      tuple: (index of each period's last bar, opens, highs, lows,
+      closes, vols), one value per period.
+
+    """
+    starts = period_starts(ons, interval)
+    if not starts.size:
+        empty = np.array([])
+        return starts, empty, empty, empty, empty, empty
+
+    ends = np.r_[starts[1:], len(ons)] - 1
+    return (
+        ends,
+        np.asarray(opens, dtype=float)[starts],
+        np.maximum.reduceat(np.asarray(highs, dtype=float), starts),
+        np.minimum.reduceat(np.asarray(lows, dtype=float), starts),
+        np.asarray(closes, dtype=float)[ends],
+        np.add.reduceat(np.asarray(vols, dtype=float), starts),
+    )
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets downsampling.
+
+    Keeps first and last points, and from each bucket in between the
+    point forming the largest triangle w/ the point kept from the
+    previous bucket and the average of the next bucket. This keeps
+    the visual peaks & troughs of a chart w/ a fraction of points.
+
+    Return
+    ------
+      np.array of int: index of points to keep, in order.
+
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = x.size
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    kept = np.zeros(threshold, dtype=np.int64)
+    kept[-1] = n - 1
+
+    # buckets between first and last point
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+
+        # average of next bucket, or the last point
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        kept[i + 1] = a
+
+    return kept
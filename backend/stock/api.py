@@ -1,6 +1,8 @@
+import json
 import logging
 from datetime import date, timedelta
 
+import numpy as np
 from django.conf.urls import url
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import Permission, User
@@ -18,6 +20,15 @@ from tastypie.models import ApiKey
 from tastypie.resources import ALL_WITH_RELATIONS, Bundle, ModelResource, Resource
 from tastypie.utils import trailing_slash
 
+from stock import dupont
+from stock import snapshot
+from stock.analytics import (
+    ANALYTICS,
+    INTERVALS,
+    HistoricalAnalytics,
+    lttb,
+    resample_ohlcv,
+)
 from stock.models import (
     BalanceSheet,
     CashFlow,
@@ -216,7 +227,8 @@ class StockResource(ModelResource):
     roe_dupont_reported_gap = fields.FloatField(
         "roe_dupont_reported_gap", null=True, use_in="detail"
     )
-    last_reporting_date = fields.DateField("last_reporting_date", null=True)
+    # read from snapshot, see `dehydrate`
+    last_reporting_date = fields.DateField(null=True, readonly=True)
     cross_statements_model = fields.ListField(
         "cross_statements_model", null=True, use_in="detail"
     )
@@ -224,14 +236,14 @@ class StockResource(ModelResource):
     sectors = fields.ManyToManyField(
         "stock.api.SectorResource", "sectors", null=True
     )
-    pe = fields.FloatField("pe", null=True)
-    pb = fields.FloatField("pb", null=True)
-    ps = fields.FloatField("ps", null=True)
-    last_lower = fields.IntegerField("last_lower", null=True)
-    last_better = fields.IntegerField("last_better", null=True)
-    price_to_cash_premium = fields.FloatField(
-        "price_to_cash_premium", null=True
-    )
+
+    # read from snapshot, see `dehydrate`
+    pe = fields.FloatField(null=True, readonly=True)
+    pb = fields.FloatField(null=True, readonly=True)
+    ps = fields.FloatField(null=True, readonly=True)
+    last_lower = fields.IntegerField(null=True, readonly=True)
+    last_better = fields.IntegerField(null=True, readonly=True)
+    price_to_cash_premium = fields.FloatField(null=True, readonly=True)
 
     class Meta:
         queryset = MyStock.objects.all()
@@ -247,12 +259,34 @@ class StockResource(ModelResource):
     def get_object_list(self, request):
         """Can only see user's sectors"""
         user = request.user
-        ids = set(
+        snapshots = dict(
             MyStock.objects.filter(sectors__user=user).values_list(
-                "id", flat=True
+                "id", "snapshot"
             )
         )
-        return MyStock.objects.filter(id__in=ids)
+
+        stocks = (
+            MyStock.objects.filter(id__in=snapshots)
+            .select_related("snapshot")
+            .prefetch_related("sectors")
+        )
+
+        # Values are read from snapshots, see `dehydrate`. Only if a
+        # stock has none yet, eg. just added, they are computed live,
+        # and then its ratios & latest bar are read w/ the stocks.
+        if None in snapshots.values():
+            stocks = stocks.with_latest_ratios().with_latest_historical()
+        return stocks
+
+    def dehydrate(self, bundle):
+        """Fill in list-level values from the stock's snapshot.
+
+        Computing them live takes a few queries per stock, thus a list
+        of stocks reads the precomputed ones, see `stock.snapshot`.
+        """
+        for name in snapshot.FIELDS:
+            bundle.data[name] = snapshot.value(bundle.obj, name)
+        return bundle
 
     def obj_update(self, bundle, **kwargs):
         stock = bundle.obj
@@ -322,7 +356,223 @@ class HistoricalResource(ModelResource):
                 "id", flat=True
             )
         )
-        return MyStockHistorical.objects.filter(stock__in=stocks)
+        return MyStockHistorical.objects.filter(
+            stock__in=stocks
+        ).select_related("stock")
+
+    def get_list(self, request, **kwargs):
+        """Listing w/ `fast=true` skips building a bundle per bar.
+
+        Charts pull years of daily bars. Instead of dehydrating each
+        of them, we fetch tuples of the filtered bars, compute derived
+        fields over arrays, and write the JSON ourselves. Filters,
+        ordering and field names are the same as the regular listing.
+        """
+        interval = request.GET.get("interval")
+        if interval and interval not in INTERVALS:
+            raise BadRequest(
+                "interval must be one of: {}".format(", ".join(INTERVALS))
+            )
+
+        max_points = request.GET.get("max_points")
+        if max_points:
+            try:
+                max_points = int(max_points)
+            except ValueError:
+                raise BadRequest("max_points must be an integer")
+
+            # LTTB keeps first & last bar, so fewer would keep them all
+            if max_points < 3:
+                raise BadRequest("max_points must be >= 3")
+
+        if not (
+            interval
+            or max_points
+            or request.GET.get("fast", "").lower() in ["1", "true"]
+        ):
+            return super().get_list(request, **kwargs)
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(
+            bundle=base_bundle, **self.remove_api_resource_names(kwargs)
+        )
+        objects = self.apply_sorting(objects, options=request.GET)
+
+        vals = self._fast_dehydrate(
+            request, list(objects.values_list(*self.FAST_FIELDS))
+        )
+        if interval or max_points:
+            vals = self._downsample(
+                vals,
+                interval,
+                max_points,
+                descending="-on" in request.GET.getlist("order_by"),
+            )
+        data = {
+            "meta": {"limit": 0, "offset": 0, "total_count": len(vals)},
+            "objects": vals,
+        }
+        return HttpResponse(json.dumps(data), content_type="application/json")
+
+    # columns the fast listing reads from DB
+    FAST_FIELDS = [
+        "id",
+        "stock_id",
+        "on",
+        "open_price",
+        "high_price",
+        "low_price",
+        "close_price",
+        "adj_close",
+        "vol",
+    ] + ANALYTICS
+
+    def _fast_dehydrate(self, request, rows):
+        """Turn bar tuples into dicts as `full_dehydrate` would."""
+        if not rows:
+            return []
+
+        cols = dict(zip(self.FAST_FIELDS, zip(*rows)))
+
+        # one query for the stocks of all bars
+        stocks = {
+            id: (symbol, shares_outstanding)
+            for id, symbol, shares_outstanding in MyStock.objects.filter(
+                id__in=set(cols["stock_id"])
+            ).values_list("id", "symbol", "shares_outstanding")
+        }
+
+        shares = np.array(
+            [stocks[x][1] or 0 for x in cols["stock_id"]], dtype=float
+        )
+        vol = np.array(cols["vol"], dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vol_over_share_outstanding = np.where(
+                shares != 0, vol / shares * 0.001, 0
+            ).tolist()
+
+        uri = self.get_resource_uri()
+        stock_uri = StockResource(
+            api_name=self._meta.api_name
+        ).get_resource_uri()
+
+        # bars whose analytics are not materialized yet
+        analytics = {}
+
+        vals = []
+        for i, row in enumerate(rows):
+            val = dict(zip(self.FAST_FIELDS, row))
+            stock_id = val["stock_id"]
+
+            if any(val[attr] is None for attr in ANALYTICS):
+                if stock_id not in analytics:
+                    analytics[stock_id] = HistoricalAnalytics.for_stock(
+                        stock_id
+                    )
+                for attr in ANALYTICS:
+                    val[attr] = analytics[stock_id].value(attr, val["on"])
+
+            val["on"] = val["on"].isoformat()
+            val["resource_uri"] = "{}{}/".format(uri, val["id"])
+            val["stock"] = "{}{}/".format(stock_uri, stock_id)
+            val["symbol"] = stocks[stock_id][0]
+            val["vol_over_share_outstanding"] = vol_over_share_outstanding[i]
+            vals.append(val)
+
+        return vals
+
+    def _downsample(self, vals, interval, max_points, descending):
+        """Resample, and then LTTB, each stock's bars.
+
+        - interval: aggregate daily bars into OHLCV bars of 1w, 1mo or
+          1q. An aggregated bar is dated by, and carries other fields
+          of, its period's last bar.
+        - max_points: keep at most this many bars per stock, chosen by
+          Largest-Triangle-Three-Buckets on close price.
+
+        """
+        by_stock = {}
+        for val in vals:
+            by_stock.setdefault(val["stock_id"], []).append(val)
+
+        downsampled = []
+        for bars in by_stock.values():
+            bars.sort(key=lambda x: x["on"])
+
+            if interval:
+                cols = {
+                    attr: [x[attr] for x in bars]
+                    for attr in [
+                        "on",
+                        "open_price",
+                        "high_price",
+                        "low_price",
+                        "close_price",
+                        "vol",
+                        "vol_over_share_outstanding",
+                    ]
+                }
+                ends, opens, highs, lows, closes, vols = resample_ohlcv(
+                    cols["on"],
+                    cols["open_price"],
+                    cols["high_price"],
+                    cols["low_price"],
+                    cols["close_price"],
+                    cols["vol"],
+                    interval,
+                )
+                starts = np.r_[0, ends[:-1] + 1].astype(np.int64)
+                vol_ratios = np.add.reduceat(
+                    np.array(cols["vol_over_share_outstanding"], dtype=float),
+                    starts,
+                )
+
+                resampled = []
+                for i, end in enumerate(ends):
+                    bar = dict(bars[end])
+                    bar["open_price"] = opens[i].item()
+                    bar["high_price"] = highs[i].item()
+                    bar["low_price"] = lows[i].item()
+                    bar["close_price"] = closes[i].item()
+                    bar["vol"] = vols[i].item()
+                    bar["vol_over_share_outstanding"] = vol_ratios[i].item()
+                    resampled.append(bar)
+                bars = resampled
+
+            if max_points:
+                kept = lttb(
+                    np.arange(len(bars)),
+                    [x["close_price"] for x in bars],
+                    max_points,
+                )
+                bars = [bars[i] for i in kept]
+
+            downsampled += bars
+
+        downsampled.sort(key=lambda x: x["on"], reverse=descending)
+        return downsampled
+
+    def full_dehydrate(self, bundle, for_list=False):
+        """Fill in analytics that haven't been materialized yet.
+
+        Analytics are stored w/ the bars by the price worker. Bars it
+        hasn't got to, eg. right after a migration, are computed here
+        once per stock, and the cache lives on the request.
+        """
+        obj = bundle.obj
+        if any(getattr(obj, attr) is None for attr in ANALYTICS):
+            cache = bundle.request.__dict__.setdefault(
+                "_historical_analytics", {}
+            )
+            if obj.stock_id not in cache:
+                cache[obj.stock_id] = HistoricalAnalytics.for_stock(
+                    obj.stock_id
+                )
+
+            for attr in ANALYTICS:
+                setattr(obj, attr, cache[obj.stock_id].value(attr, obj.on))
+
+        return super().full_dehydrate(bundle, for_list=for_list)
 
     def dehydrate_symbol(self, bundle):
         return bundle.obj.stock.symbol
@@ -722,19 +972,30 @@ class RankStockResource(RankingResource):
             for index, (name, high_to_low) in enumerate(attrs)
         ]
 
-        objects = MyStock.objects.filter(sectors__user=request.user)
+        objects = list(MyStock.objects.filter(sectors__user=request.user))
+
+        # DuPont ROE of all stocks w/ two queries instead of a few
+        # per stock
+        roes = dupont.roe_by_stock(objects)
+
         return [
-            StatSummary(index, attr, self._rank_by(objects, attr, high_to_low))
+            StatSummary(
+                index, attr, self._rank_by(objects, attr, high_to_low, roes)
+            )
             for (index, attr, high_to_low) in attrs
         ]
 
-    def _rank_by(self, objs, attr, high_to_low):
+    def _rank_by(self, objs, attr, high_to_low, roes):
         vals = []
 
         for s in objs:
-            vals.append(
-                {"id": s.id, "symbol": s.symbol, "val": getattr(s, attr)}
-            )
+            if attr == "dupont_roe":
+                val = roes[s.id]
+            elif attr == "roe_dupont_reported_gap":
+                val = dupont.reported_gap(s.roe, roes[s.id])
+            else:
+                val = getattr(s, attr)
+            vals.append({"id": s.id, "symbol": s.symbol, "val": val})
 
         # WARNING: eliminate 0 and -100, which are _invalid_ or
         # _unknown_ internally becase some data anomalies.
@@ -936,7 +1197,7 @@ class TaskResource(ModelResource):
         full=True,
         readonly=True,
     )
-    result = fields.OneToOneField(
+    result = fields.ForeignKey(
         "stock.api.TaskResultResource",
         "result",
         null=True,
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""DuPont ROE from pre-fetched statements.
+
+ROE = net profit margin * asset turnover * equity multiplier, where
+the margin comes from income statements, and turnover & multiplier
+need the balance sheet too.
+
+We used to look up the matching income statement per balance sheet,
+and the averages w/ a few more queries, for every stock we show or
+rank. Here a stock's balance sheets & income statements are read
+once, or those of many stocks in two queries, and then the model is
+computed over whole columns.
+
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from stock.fundamentals import as_of
+from stock.models import BalanceSheet
+from stock.models import IncomeStatement
+
+logger = logging.getLogger("stock")
+
+BALANCE_FIELDS = ["total_assets", "stockholders_equity", "total_debt"]
+INCOME_FIELDS = ["net_income", "total_revenue"]
+
+
+def _frames(model, fields, stocks):
+    """Statements of stocks, {stock id: data frame ordered by `on`}."""
+    rows = list(
+        model.objects.filter(stock__in=stocks)
+        .order_by("stock_id", "on")
+        .values_list("stock_id", "on", *fields)
+    )
+    df = pd.DataFrame(rows, columns=["stock_id", "on"] + fields)
+    df["on"] = pd.to_datetime(df["on"])
+    return {
+        stock_id: x.drop(columns="stock_id").reset_index(drop=True)
+        for stock_id, x in df.groupby("stock_id", sort=False)
+    }
+
+
+def _empty(fields):
+    df = pd.DataFrame([], columns=["on"] + fields)
+    df["on"] = pd.to_datetime(df["on"])
+    return df
+
+
+def statements(stocks):
+    """Balance sheets & income statements of stocks, in two queries.
+
+    Args
+    ----
+      :param: stocks, list or QuerySet of MyStock
+
+    Return
+    ------
+      dict: {stock id: (balances, incomes)}, both data frames ordered
+      by `on`, and empty if stock has none.
+    """
+    balances = _frames(BalanceSheet, BALANCE_FIELDS, stocks)
+    incomes = _frames(IncomeStatement, INCOME_FIELDS, stocks)
+    return {
+        x.id: (
+            balances.get(x.id, _empty(BALANCE_FIELDS)),
+            incomes.get(x.id, _empty(INCOME_FIELDS)),
+        )
+        for x in stocks
+    }
+
+
+def _zero(column):
+    return column.astype(float).fillna(0).to_numpy()
+
+
+def _nullable(column):
+    return [None if pd.isna(x) else x for x in column.tolist()]
+
+
+def ratio(a, b):
+    """a / b as a measure of scale, see `StatementBase._as_of_ratio`."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vals = np.where(a * b > 0, a / b, np.abs((a - b) / b))
+    return np.where(b != 0, vals, 0)
+
+
+def model(balances, incomes):
+    """ROE of each balance sheet w/ the latest income statement on or
+    before it, see `MyStock.dupont_model`.
+
+    Return
+    ------
+      list of dict: ordered by date
+    """
+    df = as_of(balances, incomes, "income")
+    df = df[df["income_on"].notna()]
+
+    assets = _zero(df["total_assets"])
+    equity = _zero(df["stockholders_equity"])
+    revenue = _zero(df["total_revenue"])
+
+    # negative equity is in trouble, not leveraged
+    leverage = np.where(equity < 0, 0, ratio(assets, equity))
+    net_profit_margin = ratio(_zero(df["net_income"]), revenue) * 100
+    with np.errstate(divide="ignore", invalid="ignore"):
+        turnover = np.where(assets != 0, revenue / assets, 0)
+    roe = net_profit_margin * turnover * leverage
+
+    columns = {
+        "net_profit_margin": net_profit_margin.tolist(),
+        "asset_turnover": (turnover * 100).tolist(),
+        "equity_multiplier": leverage.tolist(),
+        "roe": roe.tolist(),
+        # reported data
+        "revenue": _nullable(df["total_revenue"]),
+        "assets": _nullable(df["total_assets"]),
+        "debts": _nullable(df["total_debt"]),
+        "equity": _nullable(df["stockholders_equity"]),
+    }
+    return [
+        dict({"on": on}, **{key: vals[i] for key, vals in columns.items()})
+        for i, on in enumerate(x.date() for x in df["on"])
+    ]
+
+
+def roe(balances, incomes):
+    """ROE w/ avg assets & avg equity, see `MyStock.dupont_roe`.
+
+    Return
+    ------
+      float: 0 if we don't have the data
+    """
+    if balances.empty:
+        return 0
+
+    # WARNING: ignore negative equity values in average
+    positive = balances[balances["stockholders_equity"].astype(float) > 0]
+    avg_assets = positive["total_assets"].astype(float).mean()
+    avg_equity = positive["stockholders_equity"].astype(float).mean()
+    if pd.isna(avg_assets) or pd.isna(avg_equity) or not avg_assets:
+        return 0
+
+    # leverage is avg asset / avg equity
+    equity_multiplier = avg_assets / avg_equity
+
+    # turn over is latest revenue / avg asset
+    incomes = incomes[incomes["on"] <= balances["on"].iloc[-1]]
+    if incomes.empty:
+        return 0
+
+    last = incomes.iloc[-1:]
+    revenue = _zero(last["total_revenue"])
+    net_profit_margin = ratio(_zero(last["net_income"]), revenue) * 100
+    turnover = revenue / avg_assets
+    return float((net_profit_margin * turnover * equity_multiplier)[0])
+
+
+def reported_gap(reported, dupont_roe):
+    """How far off DuPont ROE is vs. reported, see
+    `MyStock.roe_dupont_reported_gap`."""
+    if reported:
+        return (reported - dupont_roe) / reported * 100
+    else:
+        return 0
+
+
+def roe_by_stock(stocks):
+    """DuPont ROE of many stocks, {stock id: roe}, in two queries."""
+    return {
+        stock_id: roe(balances, incomes)
+        for stock_id, (balances, incomes) in statements(stocks).items()
+    }
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Values derived across a stock's statements.
+
+Statements don't line up by date, eg. a company may file more income
+statements than balance sheets. So for each income statement we use
+the latest balance sheet & cash flow statement on or before it. We
+used to look those up w/ two queries per quarter. Here each series
+is read once and aligned w/ `merge_asof`, and the values are computed
+over whole columns.
+
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from stock import price_cache
+from stock.models import BalanceSheet
+from stock.models import CashFlow
+from stock.models import IncomeStatement
+from stock.models import MyStockHistorical
+
+logger = logging.getLogger("stock")
+
+INCOME_FIELDS = ["ebit", "tax_rate"]
+BALANCE_FIELDS = [
+    "total_debt",
+    "total_assets",
+    "share_issued",
+    "invested_capital",
+    "working_capital",
+    "cash_and_cash_equivalent",
+]
+CASH_FIELDS = ["free_cash_flow"]
+
+
+def _series(model, stock, fields, **filters):
+    """A stock's records as a data frame ordered by `on`."""
+    rows = list(
+        model.objects.filter(stock=stock, **filters)
+        .order_by("on")
+        .values_list("on", *fields)
+    )
+    df = pd.DataFrame(rows, columns=["on"] + fields)
+    df["on"] = pd.to_datetime(df["on"])
+    return df
+
+
+def as_of(left, right, name):
+    """Join the latest `right` row on or before each `left` row.
+
+    Args
+    ----
+      :param: left, data frame w/ an ordered `on` column
+      :param: right, data frame w/ an ordered `on` column
+      :param: name, str, `right`'s `on` is kept as column `<name>_on`,
+        which is NaT if there is no such row
+
+    Return
+    ------
+      data frame: same rows as `left`
+    """
+    right = right.assign(**{"{}_on".format(name): right["on"]})
+    return pd.merge_asof(left, right, on="on", direction="backward")
+
+
+def _nullable(column):
+    # None instead of NaN, as a model field would give
+    return [None if pd.isna(x) else x for x in column.tolist()]
+
+
+def _zero(column):
+    # a missing value counts as 0, like a falsy field
+    return column.astype(float).fillna(0).to_numpy()
+
+
+def close_prices(stock, ons):
+    """Close price on or after each date, same as `close_price` of a
+    statement.
+
+    Args
+    ----
+      :param: stock, MyStock
+      :param: ons, data frame column of datetime, ordered
+
+    Return
+    ------
+      np.array of float: 0 if there is no price yet
+    """
+    if ons.empty:
+        return np.zeros(0)
+
+    series = price_cache.open_series(stock.id)
+    if series is not None:
+        days = (ons.dt.normalize() - pd.Timestamp(price_cache.EPOCH)).dt.days
+        i = np.searchsorted(series.days, days.to_numpy(), side="left")
+        found = i < len(series)
+        i = np.minimum(i, len(series) - 1)
+        adj = np.nan_to_num(np.asarray(series.column("adj_close"))[i])
+        close = np.asarray(series.column("close_price"))[i]
+        prices = np.where(adj != 0, adj, close)
+        return np.where(found, prices, 0)
+
+    prices = _series(
+        MyStockHistorical,
+        stock,
+        ["adj_close", "close_price"],
+        on__gte=ons.iloc[0].date(),
+    )
+    df = pd.merge_asof(
+        pd.DataFrame({"on": ons}), prices, on="on", direction="forward"
+    )
+    adj = _zero(df["adj_close"])
+    return np.where(adj != 0, adj, _zero(df["close_price"]))
+
+
+def cross_statements(stock):
+    """Compute `MyStock.cross_statements_model` in a constant number
+    of queries.
+
+    Return
+    ------
+      list of dict: one per income statement, ordered by date
+    """
+    df = _series(IncomeStatement, stock, INCOME_FIELDS)
+    df = as_of(df, _series(BalanceSheet, stock, BALANCE_FIELDS), "balance")
+    df = as_of(df, _series(CashFlow, stock, CASH_FIELDS), "cash")
+
+    has_balance = df["balance_on"].notna().to_numpy()
+    has_cash = df["cash_on"].notna().to_numpy()
+
+    # debt % of assets, see `BalanceSheet.capital_structure`
+    debt = _zero(df["total_debt"])
+    assets = _zero(df["total_assets"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(
+            debt * assets > 0, debt / assets, np.abs((debt - assets) / assets)
+        )
+    capital_structure = np.where(has_balance & (assets != 0), ratio * 100, 0)
+
+    share_issued = np.where(
+        has_balance, np.array(_nullable(df["share_issued"]), dtype=object), 0
+    )
+    fcf = np.where(
+        has_cash, np.array(_nullable(df["free_cash_flow"]), dtype=object), 0
+    )
+
+    # reported invested capital, or else working capital w/o cash
+    reported = _zero(df["invested_capital"])
+    invested_capital = np.where(
+        reported != 0,
+        reported,
+        _zero(df["working_capital"]) - _zero(df["cash_and_cash_equivalent"]),
+    )
+    invested_capital = np.where(
+        has_balance & (invested_capital > 0), invested_capital, 0
+    )
+
+    ebit = _zero(df["ebit"])
+    tax_rate = _zero(df["tax_rate"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        roce = np.where(
+            (ebit != 0) & (invested_capital != 0),
+            ebit / invested_capital * 100,
+            0,
+        )
+
+        # net profit after tax
+        nopat = np.where(
+            (invested_capital != 0) & (tax_rate != 0) & (ebit != 0),
+            ebit * (1 - tax_rate),
+            0,
+        )
+        roic = np.where(
+            (nopat != 0) & (invested_capital != 0),
+            nopat / invested_capital * 100,
+            0,
+        )
+
+    ons = [x.date() for x in df["on"]]
+    columns = {
+        "capital_structure": capital_structure.tolist(),
+        "fcf": fcf.tolist(),
+        "tax_rate": _nullable(df["tax_rate"]),
+        "share_issued": share_issued.tolist(),
+        "close_price": close_prices(stock, df["on"]).tolist(),
+        "roce": np.maximum(roce, 0).tolist(),  # only positive value
+        "roic": np.maximum(roic, 0).tolist(),  # only positive value
+        "nopat": nopat.tolist(),
+        "invested_capital": invested_capital.tolist(),
+    }
+    return [
+        dict({"on": on}, **{key: vals[i] for key, vals in columns.items()})
+        for i, on in enumerate(ons)
+    ]
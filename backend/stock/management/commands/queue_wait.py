@@ -0,0 +1,43 @@
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from fin import queue_metrics
+
+
+class Command(BaseCommand):
+    help = "Report how long tasks wait in queues, see `fin.queue_metrics`."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "queues",
+            nargs="*",
+            help="Queues to report, default to all that have samples.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.REDIS_HOST:
+            raise CommandError("Queue wait is kept in redis, no REDIS_HOST")
+
+        self.stdout.write(
+            "{:<12} {:<6} {:>6} {:>8} {:>8} {:>8}".format(
+                "queue", "metric", "count", "p50", "p95", "max"
+            )
+        )
+        for queue in options["queues"] or queue_metrics.queues():
+            for metric in queue_metrics.METRICS:
+                x = queue_metrics.samples(queue, metric)
+                if not x:
+                    continue
+
+                self.stdout.write(
+                    "{:<12} {:<6} {:>6} {:>7.1f}s {:>7.1f}s {:>7.1f}s".format(
+                        queue,
+                        metric,
+                        len(x),
+                        np.percentile(x, 50),
+                        np.percentile(x, 95),
+                        max(x),
+                    )
+                )
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from stock import snapshot
+from stock.models import MyStock
+
+
+class Command(BaseCommand):
+    help = "Rebuild snapshots of all stocks, see `stock.snapshot`."
+
+    def handle(self, *args, **options):
+        ids = list(MyStock.objects.values_list("id", flat=True))
+        for stock_id in ids:
+            snapshot.refresh(stock_id)
+
+        self.stdout.write("Rebuilt {} snapshots".format(len(ids)))
@@ -0,0 +1,184 @@
+import glob
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from fin.http_fixtures import fixture_path
+
+logger = logging.getLogger("stock")
+
+CRUMB_PATH = "/v1/test/getcrumb"
+
+
+class Throttle:
+    """Token bucket, `rate` requests per second w/ a burst of `rate`."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.ts) * self.rate
+            )
+            self.ts = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Serve a request from fixtures.
+
+    Request path is the original url w/o scheme, eg.
+    `/query1.finance.yahoo.com/v7/finance/download/AAPL?...`, see
+    `fin.http_fixtures.standin_url`.
+    """
+
+    # keep-alive, as Yahoo does
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        options = self.server.options
+
+        latency = options["latency"] + random.uniform(0, options["jitter"])
+        if latency:
+            time.sleep(latency)
+
+        if not self.server.throttle.allow():
+            self.reply(429, "text/plain", "Too Many Requests")
+            return
+
+        parts = urlparse(self.path)
+        host, _, path = parts.path.lstrip("/").partition("/")
+        path = "/" + path
+
+        # yahooquery asks for a crumb before anything else
+        if path == CRUMB_PATH:
+            self.reply(200, "text/plain", "standin")
+            return
+
+        fixture = self.find(
+            fixture_path(options["fixtures"], host, path, parts.query)
+        )
+        if fixture is None:
+            self.reply(404, "text/plain", "No fixture of {}".format(self.path))
+            return
+
+        self.reply(
+            fixture["status"],
+            fixture["content_type"] or "text/plain",
+            fixture["body"],
+        )
+
+    def find(self, path):
+        """Load fixture at `path`.
+
+        W/ `any_symbol`, if this symbol has no recording, use the
+        same request of another symbol. Symbol is the last segment of
+        Yahoo paths, thus the dir a fixture is in.
+        """
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+
+        if not self.server.options["any_symbol"]:
+            return None
+
+        symbol_dir, name = os.path.split(path)
+        symbol = os.path.basename(symbol_dir)
+        others = sorted(
+            glob.glob(os.path.join(os.path.dirname(symbol_dir), "*", name))
+        )
+        if not others:
+            return None
+
+        with open(others[0]) as f:
+            fixture = json.load(f)
+        recorded = os.path.basename(os.path.dirname(others[0]))
+        fixture["body"] = fixture["body"].replace(recorded, symbol)
+        return fixture
+
+    def reply(self, status, content_type, body):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s" % (self.address_string(), format % args))
+
+
+class Command(BaseCommand):
+    help = "Serve recorded Yahoo responses, see `fin.http_fixtures`."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8899)
+        parser.add_argument(
+            "--fixtures",
+            default=settings.HTTP_RECORD_DIR,
+            help="Fixture dir, default to HTTP_RECORD_DIR.",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="Seconds added to every response.",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            default=0,
+            help="Up to this many seconds added on top of latency.",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Requests per second, beyond which we answer 429 "
+            "like Yahoo does. 0 is unlimited.",
+        )
+        parser.add_argument(
+            "--any-symbol",
+            action="store_true",
+            help="Serve another symbol's recording to a symbol that "
+            "has none, eg. to load test w/ all our stocks.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["fixtures"] or not os.path.isdir(options["fixtures"]):
+            raise CommandError("No fixture dir: {}".format(options["fixtures"]))
+
+        server = ThreadingHTTPServer(("", options["port"]), StandinHandler)
+        server.options = options
+        server.throttle = Throttle(options["rate"])
+
+        self.stdout.write(
+            "Serving {} on port {}".format(options["fixtures"], options["port"])
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""NYSE trading sessions.
+
+A daily bar only changes while its session is open, and a little
+after the close when Yahoo settles it. Nights, weekends & holidays
+have nothing new, so the price scheduler asks here whether and since
+when prices could have changed.
+
+Holidays follow NYSE rules: a holiday on Saturday is observed the
+Friday before, one on Sunday the Monday after, except New Year's Day
+on a Saturday, which isn't observed at all. Days before Independence
+Day & Christmas, and the day after Thanksgiving, close early.
+
+"""
+
+from datetime import date, datetime, time, timedelta
+
+import pytz
+from dateutil.easter import easter
+from dateutil.relativedelta import MO, TH, relativedelta
+
+TZ = pytz.timezone("America/New_York")
+
+OPEN = time(9, 30)
+CLOSE = time(16, 0)
+EARLY_CLOSE = time(13, 0)
+
+
+def _observed(day):
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def holidays(year):
+    """NYSE full day holidays of a year.
+
+    Return
+    ------
+      set: of date
+    """
+    days = {
+        # MLK, Presidents, Memorial, Labor & Thanksgiving Day
+        date(year, 1, 1) + relativedelta(weekday=MO(3)),
+        date(year, 2, 1) + relativedelta(weekday=MO(3)),
+        date(year, 5, 31) + relativedelta(weekday=MO(-1)),
+        date(year, 9, 1) + relativedelta(weekday=MO(1)),
+        date(year, 11, 1) + relativedelta(weekday=TH(4)),
+        # Good Friday
+        easter(year) - timedelta(days=2),
+        _observed(date(year, 7, 4)),
+        _observed(date(year, 12, 25)),
+    }
+
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days.add(_observed(new_year))
+
+    if year >= 2022:
+        days.add(_observed(date(year, 6, 19)))
+
+    return days
+
+
+def _early_closes(year):
+    thanksgiving = date(year, 11, 1) + relativedelta(weekday=TH(4))
+    return {
+        date(year, 7, 3),
+        thanksgiving + timedelta(days=1),
+        date(year, 12, 24),
+    }
+
+
+def is_trading_day(day):
+    return day.weekday() < 5 and day not in holidays(day.year)
+
+
+def session(day):
+    """Open & close of a trading day.
+
+    Return
+    ------
+      tuple: (open, close) as aware datetime, or None if market is
+      closed that day.
+    """
+    if not is_trading_day(day):
+        return None
+
+    close = EARLY_CLOSE if day in _early_closes(day.year) else CLOSE
+    return (
+        TZ.localize(datetime.combine(day, OPEN)),
+        TZ.localize(datetime.combine(day, close)),
+    )
+
+
+def _today(now):
+    return now.astimezone(TZ).date()
+
+
+def is_open(now):
+    """True if market is open at an aware datetime."""
+    hours = session(_today(now))
+    return hours is not None and hours[0] <= now < hours[1]
+
+
+def last_session(now):
+    """The latest session that has opened by `now`.
+
+    Return
+    ------
+      tuple: (open, close) as aware datetime
+    """
+    day = _today(now)
+    hours = session(day)
+    while hours is None or hours[0] > now:
+        day -= timedelta(days=1)
+        hours = session(day)
+    return hours
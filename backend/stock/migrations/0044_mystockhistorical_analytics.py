@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0043_mytask_result'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mystockhistorical',
+            name='gain_probability',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mystockhistorical',
+            name='last_better',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mystockhistorical',
+            name='last_lower',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mystockhistorical',
+            name='next_better',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
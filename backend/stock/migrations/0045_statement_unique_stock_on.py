@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:52
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+STATEMENTS = ['BalanceSheet', 'CashFlow', 'IncomeStatement', 'ValuationRatio']
+
+
+def remove_duplicates(apps, schema_editor):
+    # keep the latest saved row of each (stock, on)
+    for name in STATEMENTS:
+        model = apps.get_model('stock', name)
+        dups = (
+            model.objects.values('stock', 'on')
+            .annotate(cnt=Count('id'), keep=Max('id'))
+            .filter(cnt__gt=1)
+        )
+        for dup in dups:
+            model.objects.filter(stock=dup['stock'], on=dup['on']).exclude(
+                id=dup['keep']
+            ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0044_mystockhistorical_analytics'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='balancesheet',
+            unique_together={('stock', 'on')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='cashflow',
+            unique_together={('stock', 'on')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='incomestatement',
+            unique_together={('stock', 'on')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='valuationratio',
+            unique_together={('stock', 'on')},
+        ),
+    ]
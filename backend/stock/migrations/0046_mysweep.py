@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0045_statement_unique_stock_on'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MySweep',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(db_index=True, max_length=32)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('symbols', models.IntegerField(default=0)),
+                ('chunks', models.IntegerField(default=0)),
+                ('failed', models.TextField(blank=True, default='')),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_task_id(apps, schema_editor):
+    # so far a MyTask's id was the id of its celery task
+    MyTask = apps.get_model('stock', 'MyTask')
+    for task in MyTask.objects.filter(task_id=''):
+        task.task_id = str(task.id)
+        task.save(update_fields=['task_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_results', '0010_remove_duplicate_indices'),
+        ('stock', '0046_mysweep'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mytask',
+            name='kind',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='mytask',
+            name='task_id',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(fill_task_id, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='mytask',
+            name='result',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mytasks', to='django_celery_results.taskresult'),
+        ),
+    ]
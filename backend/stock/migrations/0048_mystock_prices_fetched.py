@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:07
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_last_bar(apps, schema_editor):
+    MyStock = apps.get_model('stock', 'MyStock')
+    MyStockHistorical = apps.get_model('stock', 'MyStockHistorical')
+    MyStock.objects.update(
+        last_bar=Subquery(
+            MyStockHistorical.objects.filter(stock=OuterRef('pk'))
+            .order_by('-on')
+            .values('on')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0047_mytask_task_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mystock',
+            name='last_bar',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mystock',
+            name='prices_fetched',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_last_bar, migrations.RunPython.noop),
+    ]
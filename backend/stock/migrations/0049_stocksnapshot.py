@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0048_mystock_prices_fetched'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('pe', models.FloatField(blank=True, null=True)),
+                ('pb', models.FloatField(blank=True, null=True)),
+                ('ps', models.FloatField(blank=True, null=True)),
+                ('last_lower', models.IntegerField(blank=True, null=True)),
+                ('last_better', models.IntegerField(blank=True, null=True)),
+                ('price_to_cash_premium', models.FloatField(blank=True, null=True)),
+                ('last_reporting_date', models.DateField(blank=True, null=True)),
+                ('stock', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='stock.mystock')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0049_stocksnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mysweep',
+            name='done',
+            field=models.IntegerField(default=0),
+        ),
+    ]
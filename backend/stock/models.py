@@ -7,9 +7,12 @@ import uuid
 from django.apps import apps
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models import Avg
+from django.db.models import Avg, F, OuterRef, Prefetch, Subquery
+from django.utils.functional import cached_property
 from django_celery_results.models import TaskResult
 
+from stock import price_cache
+
 logger = logging.getLogger("stock")
 logger.setLevel(logging.DEBUG)
 
@@ -34,6 +37,45 @@ class MySector(models.Model):
         return str(self.name)
 
 
+class MyStockQuerySet(models.QuerySet):
+    def with_latest_ratios(self):
+        """Annotate the latest positive P/E, P/B & P/S of every stock,
+        as `latest_pe`, `latest_pb` & `latest_ps`.
+
+        They are correlated subqueries of the same SQL statement, thus
+        no query per stock. See `MyStock.pe`.
+        """
+        return self.annotate(
+            **{
+                "latest_{}".format(x): Subquery(
+                    ValuationRatio.objects.filter(
+                        stock=OuterRef("pk"), **{"{}__gt".format(x): 0}
+                    )
+                    .order_by("-on")
+                    .values(x)[:1]
+                )
+                for x in ["pe", "pb", "ps"]
+            }
+        )
+
+    def with_latest_historical(self):
+        """Prefetch the latest bar of every stock in one query.
+
+        The bar is joined on `MyStock.last_bar`, which the price worker
+        keeps up to date, so it's an index lookup per stock rather
+        than a subquery per bar. See `MyStock.latest_historical`.
+        """
+        return self.prefetch_related(
+            Prefetch(
+                "historicals",
+                queryset=MyStockHistorical.objects.filter(
+                    on=F("stock__last_bar")
+                ),
+                to_attr="_latest_historicals",
+            )
+        )
+
+
 class MyStock(models.Model):
     symbol = models.CharField(max_length=32, unique=True)
     beta = models.FloatField(null=True, default=5)
@@ -49,9 +91,30 @@ class MyStock(models.Model):
     top_ten_institution_ownership = models.FloatField(null=True, default=-1)
     institution_count = models.IntegerField(null=True, default=-1)
 
+    # when we have last read its prices, and the latest bar we have,
+    # so the scheduler reads only what can have changed since
+    prices_fetched = models.DateTimeField(null=True, blank=True)
+    last_bar = models.DateField(null=True, blank=True)
+
+    objects = MyStockQuerySet.as_manager()
+
     def __str__(self):
         return self.symbol
 
+    @cached_property
+    def latest_historical(self):
+        """The latest bar, or None.
+
+        Several values of a stock are read off its latest bar, so it's
+        read once per instance. A list of stocks can prefetch them all
+        w/ `MyStock.objects.with_latest_historical()`.
+        """
+        prefetched = self.__dict__.get("_latest_historicals")
+        if prefetched is not None:
+            return prefetched[0] if prefetched else None
+
+        return self.historicals.order_by("-on").first()
+
     @property
     def tax_rate(self):
         return self.incomes.filter(tax_rate__gt=0).aggregate(Avg("tax_rate"))[
@@ -66,7 +129,11 @@ class MyStock(models.Model):
         a premium.
 
         """
-        hist = self.historicals.order_by("-on").first()
+        series = price_cache.open_series(self.id)
+        if series is not None:
+            return series.value("close_price", len(series) - 1)
+
+        hist = self.latest_historical
         if hist:
             return hist.close_price
         else:
@@ -74,7 +141,7 @@ class MyStock(models.Model):
 
     @property
     def last_lower(self):
-        hist = self.historicals.order_by("-on").first()
+        hist = self.latest_historical
         if hist:
             return hist.last_lower
         else:
@@ -82,12 +149,19 @@ class MyStock(models.Model):
 
     @property
     def last_better(self):
-        hist = self.historicals.order_by("-on").first()
+        hist = self.latest_historical
         if hist:
             return hist.last_better
         else:
             return None
 
+    @cached_property
+    def _dupont_statements(self):
+        # read once for all DuPont values of this stock
+        from stock import dupont
+
+        return dupont.statements([self])[self.id]
+
     @property
     def dupont_roe(self):
         """ROE by Dupont model.
@@ -108,35 +182,10 @@ class MyStock(models.Model):
 
         """
 
-        # hmm... so some symbol has no balance sheet info
-        if not self.balances.all():
-            return 0
-
-        # WARNING: ignore negative equity values in average
-        avgs = self.balances.filter(stockholders_equity__gt=0).aggregate(
-            Avg("total_assets"), Avg("stockholders_equity")
-        )
-
-        # leverage is avg asset / avg equity
-        if all(avgs.values()):
-            equity_multiplier = (
-                avgs["total_assets__avg"] / avgs["stockholders_equity__avg"]
-            )
-        else:
-            return 0
+        # avoid circular import
+        from stock import dupont
 
-        # turn over is latest revenue / avg asset
-        last_reporting_date = self.balances.order_by("-on")[0].on
-
-        incomes = self.incomes.filter(on__lte=last_reporting_date)
-        if incomes:
-            last_income = incomes.last()
-            turnover = last_income.total_revenue / avgs["total_assets__avg"]
-            return (
-                last_income.net_income_to_revenue * turnover * equity_multiplier
-            )
-        else:
-            return 0
+        return dupont.roe(*self._dupont_statements)
 
     @property
     def roe_dupont_reported_gap(self):
@@ -159,60 +208,28 @@ class MyStock(models.Model):
             more diff. If it's < 0, I'm being too optmistic (you
             should be more conservative).
         """
-        if self.roe:
-            return (self.roe - self.dupont_roe) / self.roe * 100
-        else:
-            return 0
+        # avoid circular import
+        from stock import dupont
+
+        return dupont.reported_gap(self.roe, self.dupont_roe)
 
     @property
     def dupont_model(self):
         """Build DuPont ROE model.
 
-        We are assuming the reporting dates are consistent among:
-        - balance sheet
-        - income statement
-
-        So that we could extract the three factors needed in the
-        DuPont model.
+        Reporting dates of balance sheet and income statement don't
+        always line up, so each balance sheet is paired w/ the latest
+        income statement on or before it to extract the three factors
+        needed in the DuPont model. See `stock.dupont`.
 
         Note that this is to compute ROE of each reporting period, not
         the _official_ ROE which uses avg(asset) and avg(equity).
 
         """
-        vals = []
-        for b in self.balances.all().order_by("on"):
-            leverage = b.equity_multiplier
+        # avoid circular import
+        from stock import dupont
 
-            # TODO: the assumption of dates are aligned is FALSE!
-            incomes = self.incomes.filter(on__lte=b.on).order_by("-on")
-            if not incomes:
-                continue
-
-            i = incomes[0]
-            net_profit_margin = i.net_income_to_revenue
-
-            if b.total_assets:
-                turnover = i.total_revenue / b.total_assets
-            else:
-                turnover = 0
-            roe = net_profit_margin * turnover * leverage
-
-            vals.append(
-                {
-                    "on": b.on,
-                    "net_profit_margin": net_profit_margin,
-                    "asset_turnover": turnover * 100,
-                    "equity_multiplier": leverage,
-                    "roe": roe,
-                    # reported data
-                    "revenue": i.total_revenue,
-                    "assets": b.total_assets,
-                    "debts": b.total_debt,
-                    "equity": b.stockholders_equity,
-                }
-            )
-
-        return vals
+        return dupont.model(*self._dupont_statements)
 
     @property
     def nav_model(self):
@@ -260,114 +277,82 @@ class MyStock(models.Model):
         - ROIC: https://www.investopedia.com/terms/r/returnoninvestmentcapital.asp
 
         Fortunately, all these go by the income statement as the main
-        reference.
+        reference. See `stock.fundamentals`.
 
         """
-        vals = []
-        for d in self.incomes.all().order_by("on"):
-            # Using `lte` because some company has more income
-            # statements than balance sheets.
-            capital_structure = 0
-            share_issued = 0
-            balance = self.balances.filter(on__lte=d.on).order_by("-on").first()
-            if balance:
-                capital_structure = balance.capital_structure
-                share_issued = balance.share_issued
-
-            # cash using FCF
-            # TODO: SY has 3 balance sheet, all on year end, 5 income
-            # statements, and 4 cash flow statements! So the time
-            # period alignment is a big problem.
-            fcf = 0
-            cash_statement = (
-                self.cashes.filter(on__lte=d.on).order_by("-on").first()
-            )
-            if cash_statement:
-                fcf = cash_statement.free_cash_flow
-
-            # tax
-            tax_rate = d.tax_rate
-
-            # compute ROCE
-            roce = 0
-            invested_capital = 0
-            if balance:
-                if balance.invested_capital:
-                    invested_capital = balance.invested_capital
-                else:
-                    invested_capital = (
-                        balance.working_capital
-                        - balance.cash_and_cash_equivalent
-                    )
+        # avoid circular import
+        from stock.fundamentals import cross_statements
 
-            if not invested_capital or invested_capital < 0:
-                invested_capital = 0
-            if d.ebit and invested_capital:
-                roce = d.ebit / invested_capital * 100
-
-            # compute ROIC
-            roic = 0
-            nopat = 0  # net profit after tax
-            if not invested_capital:
-                nopat = 0
-            elif d.tax_rate and d.ebit:
-                nopat = d.ebit * (1 - d.tax_rate)
-            if nopat and invested_capital:
-                roic = nopat / invested_capital * 100
-
-            vals.append(
-                {
-                    "on": d.on,
-                    "capital_structure": capital_structure,
-                    "fcf": fcf,
-                    "tax_rate": tax_rate,
-                    "share_issued": share_issued,
-                    "close_price": d.close_price,
-                    "roce": max(roce, 0),  # only positive value
-                    "roic": max(roic, 0),  # only positive value
-                    "nopat": nopat,
-                    "invested_capital": invested_capital,
-                }
-            )
-        return vals
+        return cross_statements(self)
 
-    @property
-    def pe(self):
-        tmp = self.ratios.filter(pe__gt=0).order_by("-on").first()
+    def _latest_ratio(self, name):
+        # annotated by `MyStock.objects.with_latest_ratios()`
+        annotated = "latest_{}".format(name)
+        if annotated in self.__dict__:
+            return self.__dict__[annotated]
+
+        tmp = (
+            self.ratios.filter(**{"{}__gt".format(name): 0})
+            .order_by("-on")
+            .first()
+        )
         if tmp:
-            return tmp.pe
+            return getattr(tmp, name)
         else:
             return None
 
+    @property
+    def pe(self):
+        return self._latest_ratio("pe")
+
     @property
     def pb(self):
-        tmp = self.ratios.filter(pb__gt=0).order_by("-on").first()
-        if tmp:
-            return tmp.pb
-        else:
-            return None
+        return self._latest_ratio("pb")
 
     @property
     def ps(self):
-        tmp = self.ratios.filter(ps__gt=0).order_by("-on").first()
-        if tmp:
-            return tmp.ps
-        else:
-            return None
+        return self._latest_ratio("ps")
 
     @property
     def price_to_cash_premium(self):
         tmp = self.balances.order_by("-on").first()
         if tmp:
             cash_per_share = tmp.cash_and_cash_equivalent_per_share
-            if cash_per_share:
-                return self.latest_close_price / cash_per_share
+            close_price = self.latest_close_price
+
+            # no price yet, eg. statements came in before prices
+            if cash_per_share and close_price is not None:
+                return close_price / cash_per_share
             else:
                 return None
         else:
             return None
 
 
+class StockSnapshot(models.Model):
+    """List-level values of a stock, precomputed.
+
+    Each of these takes a query or two to compute live, so a list of
+    stocks used to take a few queries per stock. Ingestion rebuilds a
+    stock's snapshot whenever its prices or statements change, see
+    `stock.snapshot`, and the stock list reads from here.
+
+    """
+
+    stock = models.OneToOneField(
+        MyStock, on_delete=models.CASCADE, related_name="snapshot"
+    )
+    updated = models.DateTimeField(auto_now=True)
+
+    pe = models.FloatField(null=True, blank=True)
+    pb = models.FloatField(null=True, blank=True)
+    ps = models.FloatField(null=True, blank=True)
+    last_lower = models.IntegerField(null=True, blank=True)
+    last_better = models.IntegerField(null=True, blank=True)
+    price_to_cash_premium = models.FloatField(null=True, blank=True)
+    last_reporting_date = models.DateField(null=True, blank=True)
+
+
 class MyStockHistorical(models.Model):
     """Historical stock data."""
 
@@ -382,6 +367,37 @@ class MyStockHistorical(models.Model):
     adj_close = models.FloatField()
     vol = models.FloatField(verbose_name=u"Volume (000)")
 
+    # Pre-computed analytics, maintained by the price worker after
+    # new bars are ingested (see `stock.analytics`). Null until then.
+    #
+    # Last lower: using the close price, when was the last time we saw
+    # a price lower than me? On a given day when I saw a drop, I
+    # always have this urge to buy on the dip. However, many times I
+    # notice that this isn't the lowest on a chart within even the
+    # recent time range, say a week. Therefore, it's useful to show a
+    # gauge when we saw this price last time. For example, a dip
+    # today, but I saw this dip last week, then it's quite a volatile
+    # signal; but if I saw this one year ago, hmm, maybe it's an
+    # opportunity, just a dip.
+    last_lower = models.IntegerField(null=True, blank=True)
+
+    # Last better: using the close price, when was the last time we
+    # saw price higher than me? The idea is to show a rebound cycle
+    # that a stock had gone low, but now is coming back to a previous
+    # price point.
+    last_better = models.IntegerField(null=True, blank=True)
+
+    # Next better: reverse side of last_lower. By peeking into the
+    # future, how long did it take for it to surpass today's **open**
+    # price? A 0 is equivalent to a PEAK that no higher price than
+    # this can be detected.
+    next_better = models.IntegerField(null=True, blank=True)
+
+    # Gain probability: pretending we can look into the future (thus
+    # we have a God's view), % of days when I could make a gain
+    # w/ higher close than today's open, eg. 10 out of 30 days = 33%.
+    gain_probability = models.FloatField(null=True, blank=True)
+
     class Meta:
         unique_together = ("stock", "on")
         index_together = ["stock", "on"]
@@ -393,115 +409,6 @@ class MyStockHistorical(models.Model):
         else:
             return 0
 
-    @property
-    def last_lower(self):
-        """Using the close price, when was the last time we saw a
-        price lower than me?
-
-                On a given day when I saw a drop, I always have this urge to
-                buy on the dip. However, many times I notice that this isn't
-                the lowest on a chart within even the recent time range, say a
-                week. Therefore, it's useful to show a gauge when we saw this
-                price last time. For example, a dip today, but I saw this dip
-                last week, then it's quite a volatile signal; but if I saw
-                this one year ago, hmm, maybe it's an opportunity, just a dip.
-
-                This serves as an indicator for:
-
-                - in what time span is today the new low?
-
-        """
-        last_saw = (
-            self.stock.historicals.filter(
-                close_price__lt=self.close_price, on__lt=self.on
-            )
-            .order_by("-on")
-            .first()
-        )
-        if last_saw:
-            return self.stock.historicals.filter(
-                on__lt=self.on, on__gte=last_saw.on
-            ).count()
-        else:
-            return 0
-
-    @property
-    def last_better(self):
-        """Using the close price, when was the last time we saw price higher
-        than me?
-
-                The idea is to show a rebound cycle that a stock had gone low,
-                but now is coming back to a previous price point. This is
-                especially true if the vlaue has been 1s because the stock is
-                continuously declining (thus the 1), then saw a large value,
-                which is the rebound. So this will show the rebound in term of
-                time, just like the last lower which shows the drop in term of
-                time.
-
-        """
-        last_saw = (
-            self.stock.historicals.filter(
-                close_price__gt=self.close_price, on__lt=self.on
-            )
-            .order_by("-on")
-            .first()
-        )
-        if last_saw:
-            return self.stock.historicals.filter(
-                on__lt=self.on, on__gte=last_saw.on
-            ).count()
-        else:
-            return 0
-
-    @property
-    def next_better(self):
-        """Reverse side of last_lower. By peeking into the future, how
-        long did it take for it to surpass today's **open** price?
-
-        If we saw a drop today, this measures how long it takes to
-        recover back to today's open price. A 0 is equivalent to a
-        PEAK that no higher price than this can be detected.
-
-        """
-        next_saw = (
-            self.stock.historicals.filter(
-                close_price__gt=self.open_price, on__gt=self.on
-            )
-            .order_by("on")
-            .first()
-        )
-        if next_saw:
-            return self.stock.historicals.filter(
-                on__gt=self.on, on__lte=next_saw.on
-            ).count()
-
-        else:
-            return 0
-
-    @property
-    def gain_probability(self):
-        """How likely we can make a gain in the future.
-
-        Taking a historical, pretending we can look into the future
-        (thus we have a God's view), counting days when I could make a
-        gain w/ higher price up to the latest price point. The
-        percentage of this count vs. the total days elapse from this
-        date represents a probability. For example, if I see 10 days
-        out of 30 days I could have made a gain on this current price,
-        the probability = 10/30=33%.
-        """
-
-        gain_days = self.stock.historicals.filter(
-            close_price__gt=self.open_price, on__gt=self.on
-        ).count()
-
-        total_days = self.stock.historicals.filter(on__gt=self.on).count()
-
-        if total_days:
-            return gain_days / total_days * 100.0
-        else:
-            return 0
-
 
 class StatementBase(models.Model):
     class Meta:
@@ -613,6 +520,16 @@ class StatementBase(models.Model):
 
         Statements are for valuation. Let's show the actual price on that date.
         """
+        series = price_cache.open_series(self.stock_id)
+        if series is not None:
+            i = series.index_on_or_after(self.on)
+            if i is None:
+                return 0
+            # prefer adj close price
+            return series.value("adj_close", i) or series.value(
+                "close_price", i
+            )
+
         tmp = MyStockHistorical.objects.filter(
             stock=self.stock, on__gte=self.on
         )
@@ -751,6 +668,9 @@ class IncomeStatement(StatementBase):
     basic_eps = models.FloatField(null=True, blank=True, default=0)
     tax_rate = models.FloatField(null=True, blank=True, default=0)
 
+    class Meta:
+        unique_together = ("stock", "on")
+
     @property
     def net_income_to_revenue(self):
         """Als knowns as net profit margin.
@@ -947,6 +867,9 @@ class CashFlow(StatementBase):
         null=True, blank=True, default=0
     )
 
+    class Meta:
+        unique_together = ("stock", "on")
+
     @property
     def cash_change_pcnt(self):
         # could be division zero
@@ -1029,6 +952,9 @@ class ValuationRatio(models.Model):
     peg = models.FloatField(null=True, blank=True, default=0)
     ps = models.FloatField(null=True, blank=True, default=0)
 
+    class Meta:
+        unique_together = ("stock", "on")
+
 
 class BalanceSheet(StatementBase):
     stock = models.ForeignKey(
@@ -1324,6 +1250,9 @@ class BalanceSheet(StatementBase):
     cash_financial = models.FloatField(null=True, blank=True, default=0)
     share_issued = models.FloatField(null=True, blank=True, default=0)
 
+    class Meta:
+        unique_together = ("stock", "on")
+
     @property
     def total_liability(self):
         return self.total_assets - self.stockholders_equity
@@ -1634,6 +1563,13 @@ class MyDiary(models.Model):
         else:
             stock = self.stock
 
+        series = price_cache.open_series(stock.id)
+        if series is not None:
+            i = series.index_on_or_before(self.created.date())
+            if i is None:
+                return 0
+            return series.value("close_price", i)
+
         historical = (
             MyStockHistorical.objects.filter(
                 stock=stock, on__lte=self.created.date()
@@ -1697,20 +1633,57 @@ class MyTask(models.Model):
     on using it to track task we have initiated. Also, it lacks
     reference to the stock this task is applied to.
 
+    Users asking to refresh the same stock share one celery task, see
+    `stock.refresh`, thus each of them has a MyTask of the same
+    `task_id`.
+
     """
 
     # task has a user ownership
     user = models.ForeignKey(
         User, related_name="tasks", on_delete=models.CASCADE
     )
-    result = models.OneToOneField(
+    result = models.ForeignKey(
         TaskResult,
         on_delete=models.CASCADE,
         null=True,
         blank=True,
-        related_name="mytask",
+        related_name="mytasks",
     )
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    task_id = models.CharField(max_length=255, db_index=True, default="")
+
+    # kind of data it refreshes, key of `settings.REFRESH_TTL`
+    kind = models.CharField(max_length=32, blank=True, default="")
     state = models.CharField(max_length=128)
     stocks = models.ManyToManyField(MyStock, related_name="tasks")
+
+
+class MySweep(models.Model):
+    """A run of a periodic task over all stocks, eg. `price_daily`.
+
+    Created when a sweep is dispatched, and marked finished when its
+    last chunk is done. A sweep that is not finished yet keeps
+    another one of the same kind from starting.
+
+    """
+
+    kind = models.CharField(max_length=32, db_index=True)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    symbols = models.IntegerField(default=0)
+    chunks = models.IntegerField(default=0)
+
+    # chunks done so far
+    done = models.IntegerField(default=0)
+
+    # symbols that raised, comma separated
+    failed = models.TextField(blank=True, default="")
+
+    @property
+    def duration(self):
+        if not self.finished:
+            return None
+        return (self.finished - self.started).total_seconds()
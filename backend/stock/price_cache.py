@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped columnar cache of stock prices.
+
+One file per stock, `<stock id>.npy`, holding a 2D float64 array w/
+one row per column in `COLUMNS`, so each column is contiguous. Dates
+are stored as days since epoch.
+
+The price worker rewrites a stock's file after it ingests new bars.
+Readers, web or worker processes, map the file read-only, so lookups
+are array indexing and `searchsorted` instead of a query. If a stock
+has no file yet, `open_series` returns None and caller should fall
+back to DB.
+
+"""
+
+import functools
+import logging
+import os
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger("stock")
+
+COLUMNS = [
+    "on",
+    "open_price",
+    "high_price",
+    "low_price",
+    "close_price",
+    "adj_close",
+    "vol",
+]
+
+EPOCH = date(1970, 1, 1)
+
+# Each mapping holds a file descriptor, so only keep the most recently
+# used ones open, or a process that reads many stocks runs out of them.
+MAX_OPEN = 128
+
+
+def _path(stock_id):
+    return os.path.join(settings.PRICE_CACHE_DIR, "{}.npy".format(stock_id))
+
+
+def _to_day(on):
+    return (on - EPOCH).days
+
+
+class PriceSeries:
+    """A stock's prices, ordered by date."""
+
+    def __init__(self, data):
+        self.data = data
+        self.days = data[0]
+
+    def __len__(self):
+        return self.days.size
+
+    def column(self, name):
+        return self.data[COLUMNS.index(name)]
+
+    def dates(self):
+        return self.days.astype("datetime64[D]").tolist()
+
+    def value(self, name, i):
+        return float(self.data[COLUMNS.index(name), i])
+
+    def index_on_or_before(self, on):
+        """Index of the latest bar on or before date `on`, or None."""
+        i = np.searchsorted(self.days, _to_day(on), side="right") - 1
+        if i < 0:
+            return None
+        return int(i)
+
+    def index_on_or_after(self, on):
+        """Index of the earliest bar on or after date `on`, or None."""
+        i = np.searchsorted(self.days, _to_day(on), side="left")
+        if i >= len(self):
+            return None
+        return int(i)
+
+
+def refresh(stock_id):
+    """Rewrite a stock's cache file from DB.
+
+    File is written aside and then renamed, so readers see either the
+    old or the new one, never a partial one. Readers that have mapped
+    the old file keep their view until they reopen.
+
+    """
+
+    # avoid circular import
+    from stock.models import MyStockHistorical
+
+    rows = list(
+        MyStockHistorical.objects.filter(stock_id=stock_id)
+        .order_by("on")
+        .values_list(*COLUMNS)
+    )
+
+    path = _path(stock_id)
+    if not rows:
+        # an empty array can't be mapped
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    data = np.empty((len(COLUMNS), len(rows)), dtype=np.float64)
+    data[0] = [_to_day(x[0]) for x in rows]
+    data[1:] = np.array([x[1:] for x in rows], dtype=np.float64).T
+
+    os.makedirs(settings.PRICE_CACHE_DIR, exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp, path)
+
+    logger.debug("[{}] cached {} bars".format(stock_id, len(rows)))
+
+
+def open_series(stock_id):
+    """Map a stock's cache file.
+
+    Return
+    ------
+      PriceSeries, or None if stock has no cache file.
+
+    """
+    path = _path(stock_id)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    return _open(stock_id, mtime)
+
+
+@functools.lru_cache(maxsize=MAX_OPEN)
+def _open(stock_id, mtime):
+    # keyed on mtime, so a rewritten file is mapped again
+    return PriceSeries(np.load(_path(stock_id), mmap_mode="r"))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Coalesce user requested refreshes of a symbol.
+
+Adding a stock, editing a sector, or signing up all ask to refresh
+the symbols involved. W/o coordination, five users sharing AAPL queue
+the same chains five times.
+
+Instead, the first request of a (symbol, kind of data) claims it for
+`settings.REFRESH_TTL` seconds w/ the id of the task it's about to
+apply. Requests that come later within the TTL find that task: while
+it's in flight they attach to it, once it's done the data is fresh
+and there is nothing to do.
+
+Claims live in redis so all web processes see them. W/o redis, eg.
+running locally, each process keeps its own.
+
+"""
+
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger("stock")
+
+_client = None
+
+# in-process claims: {key: (task id, expires)}
+_local = {}
+_local_lock = threading.Lock()
+
+
+def _key(kind, symbol):
+    return "refresh:{}:{}".format(kind, symbol)
+
+
+def _redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis(host=settings.REDIS_HOST, port=6379, db=0)
+    return _client
+
+
+def _redis_claim(key, task_id, ttl):
+    client = _redis()
+
+    # the claim may expire in between, then try again
+    for i in range(3):
+        if client.set(key, task_id, nx=True, ex=ttl):
+            return task_id
+        holder = client.get(key)
+        if holder is not None:
+            return holder.decode("utf-8")
+    return task_id
+
+
+def _local_claim(key, task_id, ttl):
+    with _local_lock:
+        now = time.monotonic()
+        holder, expires = _local.get(key, (None, 0))
+        if holder is None or expires <= now:
+            _local[key] = (task_id, now + ttl)
+            return task_id
+        return holder
+
+
+def claim(kind, symbol, task_id):
+    """Claim refreshing a symbol's kind of data.
+
+    Args
+    ----
+      :param: kind, str, key of `settings.REFRESH_TTL`, eg. "prices"
+      :param: symbol, str
+      :param: task_id, str, id of the task we'd apply
+
+    Return
+    ------
+      str: `task_id` if it's ours to apply, or id of the task that has
+      claimed it already.
+    """
+    ttl = settings.REFRESH_TTL.get(kind, 0)
+    if not ttl:
+        return task_id
+
+    key = _key(kind, symbol)
+    if settings.REDIS_HOST:
+        try:
+            return _redis_claim(key, task_id, ttl)
+        except redis.RedisError:
+            logger.exception("refresh claims fall back to this process")
+
+    return _local_claim(key, task_id, ttl)
+
+
+def release(kind, symbol):
+    """Drop a claim, eg. its task has failed, so we can try again."""
+    key = _key(kind, symbol)
+    if settings.REDIS_HOST:
+        try:
+            _redis().delete(key)
+        except redis.RedisError:
+            logger.exception("failed to release {}".format(key))
+
+    with _local_lock:
+        _local.pop(key, None)
@@ -52,14 +52,12 @@ def on_new_task_result(sender, instance, **kwargs):
     """Link TaskResult to MyTask"""
     result = instance
 
-    # sync w/ MyTask
-    my_task = MyTask.objects.filter(id=result.task_id).first()
-    if my_task:
-        my_task.result = result
-        my_task.state = result.status
-        my_task.save()
+    # sync w/ MyTask of every user who asked for it
+    MyTask.objects.filter(task_id=result.task_id).update(
+        result=result, state=result.status
+    )
 
     # we are done, remove yourself
     if result.status == "SUCCESS":
-        # this deletion, in turn, will delete the linked MyTask also
+        # this deletion, in turn, will delete the linked MyTasks also
         result.delete()
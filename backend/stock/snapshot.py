@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Precomputed list-level values of stocks, see `StockSnapshot`.
+
+Workers call `refresh` after they have ingested new prices or
+statements of a stock. A stock w/o a snapshot yet, eg. just added,
+is computed live by the API. `manage.py rebuild_snapshots` builds
+them all, eg. after a deploy.
+
+"""
+
+import logging
+
+from stock.models import MyStock, StockSnapshot
+
+logger = logging.getLogger("stock")
+
+# MyStock values kept in a snapshot
+FIELDS = [
+    "pe",
+    "pb",
+    "ps",
+    "last_lower",
+    "last_better",
+    "price_to_cash_premium",
+    "last_reporting_date",
+]
+
+
+def refresh(stock_id):
+    """Rebuild a stock's snapshot from its current data."""
+
+    # a fresh instance, w/o values cached from before ingestion
+    stock = MyStock.objects.with_latest_ratios().get(id=stock_id)
+    vals = {x: getattr(stock, x) for x in FIELDS}
+    StockSnapshot.objects.update_or_create(stock=stock, defaults=vals)
+
+    logger.debug("[{}] snapshot {}".format(stock.symbol, vals))
+
+
+def value(stock, name):
+    """A stock's value from its snapshot, or computed live if it has
+    none yet."""
+    try:
+        return getattr(stock.snapshot, name)
+    except StockSnapshot.DoesNotExist:
+        return getattr(stock, name)
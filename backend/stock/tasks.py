@@ -1,62 +1,166 @@
+import logging
 from datetime import date, timedelta
 
-from celery import chain
+from celery import chain, states, uuid
 from celery.schedules import crontab
+from celery.signals import worker_process_init
 from django.contrib.auth.models import User
 from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from fin.celery import app
-from fin.tor_handler import PlainUtility
-from stock.models import MyNews, MyStock, MyTask
-from stock.workers.get_balance_sheet import MyBalanceSheet
-from stock.workers.get_cash_flow_statement import MyCashFlowStatement
+from fin.tor_handler import get_agent
+from stock import market
+from stock import refresh
+from stock.models import MyNews, MyStock, MySweep, MyTask
+from stock.workers.batch import BATCH_SIZE
+from stock.workers.batch import yahoo_pool_stats
+from stock.workers.batch import yahoo_session
 from stock.workers.get_historical import MyStockHistoricalYahoo
-from stock.workers.get_income_statement import MyIncomeStatement
 from stock.workers.get_news import MyNewsWorker
+from stock.workers.get_statements import MyStatements
 from stock.workers.get_summary import MySummary
-from stock.workers.get_valuation_ratio import MyValuationRatio
 
+logger = logging.getLogger("stock")
 
-@app.task(queue="summary")
-def __summary_consumer(whatever, symbol):
-    crawler = MySummary(symbol)
-    crawler.get()
+# symbols per price task
+PRICE_CHUNK_SIZE = 20
 
+# Queue of refreshes a user asked for. Sweeps put hundreds of tasks in
+# the price & statement queues, so these get workers of their own.
+INTERACTIVE_QUEUE = "interactive"
 
-@app.task(queue="statement", rate_limit="12/m")
-def __balance_sheet_consumer(whatever, symbol):
-    crawler = MyBalanceSheet(symbol)
-    crawler.get()
+# an unfinished sweep older than this is considered dead, eg. its
+# worker was killed before the callback ran
+SWEEP_TIMEOUT = timedelta(hours=1)
 
+# how often to look for stale prices
+PRICE_TICK = 300.0
 
-@app.task(queue="statement", rate_limit="12/m")
-def __income_statement_consumer(whatever, symbol):
-    crawler = MyIncomeStatement(symbol)
-    crawler.get()
+# while market is open, read a symbol's prices at most this often
+PRICE_INTERVAL = timedelta(minutes=15)
+
+# Yahoo may still revise a bar this long after the close
+PRICE_SETTLE = timedelta(minutes=30)
+
+# a symbol w/o a new bar for this long is likely delisted or halted,
+# read it once a day
+DORMANT_AFTER = timedelta(days=30)
 
 
-@app.task(queue="statement", rate_limit="12/m")
-def __cash_flow_statement_consumer(whatever, symbol):
-    crawler = MyCashFlowStatement(symbol)
+@worker_process_init.connect
+def init_http(**kwargs):
+    # One pool of keep-alive connections per worker process, shared
+    # by all tasks it runs. If Yahoo isn't reachable now, the session
+    # will be created on first use.
+    get_agent()
+    try:
+        yahoo_session()
+    except Exception:
+        logger.exception("failed to set up yahooquery session")
+
+
+def log_pool_stats():
+    stats = get_agent().pool_stats()
+    stats.update(yahoo_pool_stats())
+    for host, x in stats.items():
+        logger.info(
+            "{}: {} requests, {} new connections, {:.0f}% reused".format(
+                host, x["requests"], x["connections"], x["reuse"]
+            )
+        )
+
+
+@app.task(queue="summary")
+def __summary_consumer(whatever, symbol):
+    crawler = MySummary(symbol)
     crawler.get()
 
 
-@app.task(queue="summary", rate_limit="12/m")
-def __valuation_ratio_consumer(whatever, symbol):
-    crawler = MyValuationRatio(symbol)
+@app.task(queue="statement")
+def __statements_consumer(symbol):
+    crawler = MyStatements(symbol)
     crawler.get()
 
 
 @app.task(queue="price")
 def __yahoo_consumer(symbol):
-    http_agent = PlainUtility()
-    crawler = MyStockHistoricalYahoo(http_agent)
+    crawler = MyStockHistoricalYahoo(get_agent())
     crawler.parser(symbol)
 
 
+def _refresh(user, stock, kind, job):
+    """Apply a refresh job of a stock, unless another user's covers it.
+
+    The requester gets a MyTask of the job we apply, or of the task in
+    flight it's waiting on. Like any MyTask, it's removed once that
+    task has succeeded. If the data is fresh, there is nothing to wait
+    on, thus no MyTask is left either.
+
+    Arguments
+    ---------
+
+      user: `User`: Requesting user.
+      stock: `MyStock`
+      kind: string: Kind of data, key of `settings.REFRESH_TTL`.
+      job: `Signature`: What to apply.
+
+    Return
+    ------
+      None
+    """
+
+    # Save task before claiming, so who comes next and finds our
+    # claim can also find the task.
+    task_id = uuid()
+    my_task = MyTask.objects.create(
+        task_id=task_id, kind=kind, state=states.PENDING, user=user
+    )
+    my_task.stocks.add(stock)
+
+    holder = refresh.claim(kind, stock.symbol, task_id)
+    if holder != task_id:
+        requested = MyTask.objects.filter(task_id=holder)
+        if not requested.exists():
+            # done, and cleaned up w/ its result
+            logger.debug("[{}] {} is fresh".format(stock.symbol, kind))
+            my_task.delete()
+            return
+
+        if not requested.exclude(state__in=states.PROPAGATE_STATES).exists():
+            # it has failed, try again
+            refresh.release(kind, stock.symbol)
+            holder = refresh.claim(kind, stock.symbol, task_id)
+
+    # someone else's in flight, so I'm waiting on it too
+    if holder != task_id:
+        my_task.task_id = holder
+        my_task.save()
+        logger.debug("[{}] {} joins {}".format(stock.symbol, kind, holder))
+
+        # it may have finished & been cleaned up just now
+        others = MyTask.objects.filter(task_id=holder).exclude(id=my_task.id)
+        if not others.exists():
+            my_task.delete()
+        return
+
+    try:
+        job.apply_async(task_id=task_id)
+    except Exception:
+        # so whoever has joined it won't wait forever
+        refresh.release(kind, stock.symbol)
+        MyTask.objects.filter(task_id=task_id).update(state=states.FAILURE)
+        raise
+
+
 def batch_update_helper(user, symbol):
     """Helper function to build stock scan tasks.
 
+    A stock refreshed recently, or being refreshed, by another request
+    is not queued again, see `stock.refresh`. Tasks go to the
+    interactive queue, ahead of sweeps.
+
     Arguments
     ---------
 
@@ -67,49 +171,156 @@ def batch_update_helper(user, symbol):
     ------
       None
     """
+    stock = MyStock.objects.get(symbol=symbol)
+
     # get price
-    get_prices = chain(__yahoo_consumer.s(symbol), __summary_consumer.s(symbol))
-
-    # get statements
-    get_statements = chain(
-        __balance_sheet_consumer.s(None, symbol),
-        __income_statement_consumer.s(symbol),
-        __cash_flow_statement_consumer.s(symbol),
-        __valuation_ratio_consumer.s(symbol),
+    get_prices = chain(
+        __yahoo_consumer.s(symbol).set(queue=INTERACTIVE_QUEUE),
+        __summary_consumer.s(symbol).set(queue=INTERACTIVE_QUEUE),
+    )
+
+    # get statements, all of them in one go
+    get_statements = __statements_consumer.s(symbol).set(
+        queue=INTERACTIVE_QUEUE
     )
 
     # https://stackoverflow.com/questions/42620917/immediately-access-django-celery-results-taskresult-after-starting
-    task_1 = get_prices.apply_async()
-    task_2 = get_statements.apply_async()
+    _refresh(user, stock, "prices", get_prices)
+    _refresh(user, stock, "statements", get_statements)
+
+
+def _chunk_done(sweep_id, failed):
+    """Count a chunk of a sweep as done, and finish the sweep w/ its
+    last chunk.
+
+    Chunks report here themselves instead of through a chord callback,
+    because a chord reads the chunks' results back from the result
+    backend, which `signals.on_new_task_result` deletes as soon as
+    they are stored.
+    """
+    with transaction.atomic():
+        sweep = MySweep.objects.select_for_update().get(id=sweep_id)
+        sweep.done += 1
+        sweep.failed = ",".join(filter(None, [sweep.failed] + failed))
+        if sweep.done >= sweep.chunks:
+            sweep.finished = timezone.now()
+        sweep.save()
+
+    if sweep.finished:
+        logger.info(
+            "price sweep of {} symbols took {:.0f}s, {} failed".format(
+                sweep.symbols,
+                sweep.duration,
+                len(sweep.failed.split(",")) if sweep.failed else 0,
+            )
+        )
+
+
+@app.task(queue="price")
+def __price_chunk_consumer(symbols, sweep_id):
+    """Read prices of a chunk of symbols.
+
+    A symbol that fails is logged and skipped, and recorded as failed
+    on the sweep.
+    """
+    crawler = MyStockHistoricalYahoo(get_agent())
+
+    failed = []
+    try:
+        for symbol in symbols:
+            try:
+                crawler.parser(symbol)
+            except Exception:
+                logger.exception("[{}] failed to read prices".format(symbol))
+                failed.append(symbol)
+    finally:
+        _chunk_done(sweep_id, failed)
+
+    log_pool_stats()
+
+
+def stale_prices(now):
+    """Stocks whose prices can have changed since we last read them.
+
+    While market is open, and a little while after the close, that's
+    any stock not read for `PRICE_INTERVAL`. Otherwise, it's those
+    not read since the last session has settled, which is none most
+    of the time.
 
-    # save task
-    for task in [task_1, task_2]:
-        saved_task = MyTask(id=task.id, state=task.state, user=user)
-        saved_task.save()
-        saved_task.stocks.add(MyStock.objects.get(symbol=symbol))
+    Arguments
+    ---------
+      now: `datetime`: aware
+
+    Return
+    ------
+      QuerySet: of `MyStock`
+    """
+    opened, closed = market.last_session(now)
+    if now < closed + PRICE_SETTLE:
+        cutoff = now - PRICE_INTERVAL
+    else:
+        cutoff = closed + PRICE_SETTLE
+
+    dormant = (opened - DORMANT_AFTER).date()
+    return MyStock.objects.filter(
+        Q(prices_fetched__isnull=True)
+        | Q(last_bar__gte=dormant, prices_fetched__lt=cutoff)
+        | Q(prices_fetched__lt=min(cutoff, now - timedelta(days=1)))
+    )
 
 
 @app.task(queue="price")
 def price_daily():
-    http_agent = PlainUtility()
+    """Read prices of stale stocks, see `stale_prices`."""
+    # don't pile up sweeps if the last one is still running
+    running = MySweep.objects.filter(
+        kind="price",
+        finished__isnull=True,
+        started__gte=timezone.now() - SWEEP_TIMEOUT,
+    )
+    if running.exists():
+        logger.info("price sweep is still running, skip")
+        return
 
-    for stock in MyStock.objects.all():
-        # daily price
-        MyStockHistoricalYahoo(http_agent).parser(stock.symbol)
+    symbols = list(
+        stale_prices(timezone.now()).values_list("symbol", flat=True)
+    )
+    if not symbols:
+        logger.debug("no stale prices")
+        return
+
+    chunks = [
+        symbols[i : i + PRICE_CHUNK_SIZE]
+        for i in range(0, len(symbols), PRICE_CHUNK_SIZE)
+    ]
+    sweep = MySweep.objects.create(
+        kind="price", symbols=len(symbols), chunks=len(chunks)
+    )
+
+    # chunks run in parallel across the price queue, and the last one
+    # done finishes the sweep
+    for x in chunks:
+        __price_chunk_consumer.delay(x, sweep.id)
 
 
 @app.task(queue="statement")
-def statement_daily():
-    for stock in MyStock.objects.all():
-        symbol = stock.symbol
+def __statement_batch_consumer(symbols):
+    # summary info
+    MySummary(symbols).get()
 
-        # summary info
-        MySummary(symbol).get()
+    # balance sheet, income, cash flow & valuation
+    MyStatements(symbols).get()
 
-        MyBalanceSheet(symbol).get()
-        MyIncomeStatement(symbol).get()
-        MyCashFlowStatement(symbol).get()
-        MyValuationRatio(symbol).get()
+    log_pool_stats()
+
+
+@app.task(queue="statement")
+def statement_daily():
+    # Each batch of symbols is fetched w/ one Ticker, so a sweep
+    # is as many tasks as there are batches.
+    symbols = list(MyStock.objects.values_list("symbol", flat=True))
+    for i in range(0, len(symbols), BATCH_SIZE):
+        __statement_batch_consumer.delay(symbols[i : i + BATCH_SIZE])
 
 
 @app.task(queue="news")
@@ -141,9 +352,10 @@ def remove_old_news():
 
 @app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
-    # Pull daily price at midnight everyday
+    # Read prices that can have changed, which is often while market
+    # is open and hardly ever when it's closed
     sender.add_periodic_task(
-        600.0, price_daily.s(), name="Get price every 10 minutes"
+        PRICE_TICK, price_daily.s(), name="Get stale prices"
     )
 
     # Pull statement every 24 hours in case there are new ones
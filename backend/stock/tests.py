@@ -0,0 +1,891 @@
+import json
+import os
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from unittest import mock
+from urllib.parse import parse_qsl, urlparse
+
+import numpy as np
+import pytz
+from celery import states
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Avg
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test import override_settings
+from django_celery_results.models import TaskResult
+from requests_futures.sessions import FuturesSession
+
+from fin import http_cache
+from fin import rate_limit
+from fin.celery import app
+from fin.http_cache import DAY
+from stock import analytics
+from stock import dupont
+from stock import market
+from stock import refresh
+from stock.models import (
+    BalanceSheet,
+    IncomeStatement,
+    MyStock,
+    MyStockHistorical,
+    MySweep,
+    MyTask,
+    ValuationRatio,
+)
+from stock.tasks import __price_chunk_consumer as price_chunk_consumer
+from stock.tasks import _refresh
+from stock.tasks import stale_prices
+from stock.workers.batch import YahooTransport
+from stock.workers.batch import response
+from stock.workers.get_statements import MyStatements
+from stock.workers.get_summary import MySummary
+
+
+class PriceSweepTest(TestCase):
+    """Chunks of a price sweep run w/ their results stored, thus going
+    through `signals.on_new_task_result`, as on a worker."""
+
+    def setUp(self):
+        self.eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+
+    def tearDown(self):
+        app.conf.task_always_eager = self.eager
+
+    def parser(self, symbol):
+        if symbol == "AAA":
+            raise ValueError("no data")
+
+    @mock.patch.object(price_chunk_consumer, "store_eager_result", True)
+    @mock.patch("stock.tasks.log_pool_stats")
+    @mock.patch("stock.tasks.get_agent")
+    @mock.patch("stock.tasks.MyStockHistoricalYahoo")
+    def test_last_chunk_finishes_sweep(self, crawler, agent, stats):
+        crawler.return_value.parser.side_effect = self.parser
+
+        sweep = MySweep.objects.create(kind="price", symbols=3, chunks=2)
+        price_chunk_consumer.delay(["AAA", "BBB"], sweep.id)
+
+        sweep.refresh_from_db()
+        self.assertEqual(sweep.done, 1)
+        self.assertIsNone(sweep.finished)
+
+        price_chunk_consumer.delay(["CCC"], sweep.id)
+
+        sweep.refresh_from_db()
+        self.assertEqual(sweep.done, 2)
+        self.assertIsNotNone(sweep.finished)
+        self.assertEqual(sweep.failed, "AAA")
+
+        # results were stored, and cleaned up
+        self.assertFalse(TaskResult.objects.exists())
+
+
+@override_settings(REDIS_HOST=None, REFRESH_TTL={"prices": 60})
+class RefreshTest(TestCase):
+    def setUp(self):
+        self.stock = MyStock.objects.create(symbol="AAPL")
+        # w/o refreshing their sample stocks
+        with mock.patch("stock.signals.batch_update_helper"):
+            self.users = [
+                User.objects.create(username="u{}".format(i)) for i in range(3)
+            ]
+        self.job = mock.Mock()
+        self.addCleanup(refresh._local.clear)
+
+    def test_requests_share_a_task_and_leave_no_task_behind(self):
+        _refresh(self.users[0], self.stock, "prices", self.job)
+        _refresh(self.users[1], self.stock, "prices", self.job)
+
+        self.job.apply_async.assert_called_once()
+        task_id = self.job.apply_async.call_args.kwargs["task_id"]
+        self.assertEqual(
+            list(MyTask.objects.values_list("task_id", "state")),
+            [(task_id, states.PENDING)] * 2,
+        )
+
+        # its result, when stored, cleans up every MyTask of it
+        TaskResult.objects.create(task_id=task_id, status=states.SUCCESS)
+        self.assertFalse(MyTask.objects.exists())
+
+        # data is fresh, nothing to wait on
+        _refresh(self.users[2], self.stock, "prices", self.job)
+        self.job.apply_async.assert_called_once()
+        self.assertFalse(MyTask.objects.exists())
+
+
+class FakeYahoo:
+    """Answers fundamentals timeseries requests like Yahoo does, w/ a
+    record of the types we have data of."""
+
+    DATA = {
+        "quarterlyTotalAssets": {"raw": 3.5e11, "currencyCode": "USD"},
+        "quarterlyPeRatio": {"raw": 25.0},
+    }
+
+    def request(self, method, url, **kwargs):
+        parts = urlparse(url)
+        if parts.path.endswith("getcrumb"):
+            return response(url, 200, "text/plain", "crumb")
+
+        symbol = parts.path.rsplit("/", 1)[-1]
+        result = []
+        for t in dict(parse_qsl(parts.query))["type"].split(","):
+            x = {"meta": {"symbol": [symbol], "type": [t]}}
+            if t in self.DATA:
+                val = dict(self.DATA[t])
+                x[t] = [
+                    dict(
+                        asOfDate="2024-03-31",
+                        periodType="3M",
+                        reportedValue={"raw": val.pop("raw")},
+                        **val
+                    )
+                ]
+            result.append(x)
+
+        body = {"timeseries": {"result": result, "error": None}}
+        return response(url, 200, "application/json", json.dumps(body))
+
+
+class FakeCurl:
+    """Answers every request, from a new local port every `per` of
+    them, like curl does w/ keep-alive connections."""
+
+    def __init__(self, per):
+        self.per = per
+        self.num = 0
+
+    def request(self, method, url, **kwargs):
+        r = response(url, 200, "text/plain", "ok")
+        r.local_ip = "10.0.0.1"
+        r.local_port = 40000 + self.num // self.per
+        self.num += 1
+        return r
+
+
+@override_settings(HTTP_CACHE_DIR="", RATE_LIMITS={})
+class YahooTransportTest(TestCase):
+    def test_pool_stats(self):
+        transport = YahooTransport(FakeCurl(per=4))
+        for i in range(8):
+            transport.request(
+                "GET", "https://query2.finance.yahoo.com/v7/x/{}".format(i)
+            )
+
+        self.assertEqual(
+            transport.pool_stats(),
+            {
+                "query2.finance.yahoo.com": {
+                    "requests": 8,
+                    "connections": 2,
+                    "reuse": 75.0,
+                }
+            },
+        )
+
+    def test_crumb_is_shared(self):
+        inner = FakeCurl(per=1)
+        transport = YahooTransport(inner)
+        url = "https://query2.finance.yahoo.com/v1/test/getcrumb"
+        for _ in range(3):
+            self.assertEqual(transport.request("GET", url).text, "ok")
+        self.assertEqual(inner.num, 1)
+
+
+@override_settings(HTTP_CACHE_DIR="", RATE_LIMITS={})
+class StatementsTest(TestCase):
+    def setUp(self):
+        self.stock = MyStock.objects.create(symbol="AAPL")
+        session = FuturesSession(
+            max_workers=2, session=YahooTransport(FakeYahoo())
+        )
+        patcher = mock.patch(
+            "stock.workers.batch.yahoo_session", return_value=session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_valuation_reaches_persister(self):
+        MyStatements("AAPL").get()
+
+        self.assertEqual(
+            BalanceSheet.objects.get(stock=self.stock).total_assets, 350
+        )
+        self.assertEqual(ValuationRatio.objects.get(stock=self.stock).pe, 25)
+
+
+class FakeSummary:
+    """Answers quoteSummary requests like Yahoo does. A fund has no
+    institution ownership."""
+
+    MODULES = {
+        "financialData": {"returnOnAssets": {"raw": 0.2}},
+        "defaultKeyStatistics": {"heldPercentInstitutions": {"raw": 0.6}},
+        "majorHoldersBreakdown": {"institutionsCount": {"raw": 5000}},
+        "institutionOwnership": {
+            "ownershipList": [
+                {"organization": "A", "pctHeld": {"raw": 0.1}},
+                {"organization": "B", "pctHeld": {"raw": 0.05}},
+            ]
+        },
+    }
+
+    def request(self, method, url, **kwargs):
+        parts = urlparse(url)
+        if parts.path.endswith("getcrumb"):
+            return response(url, 200, "text/plain", "crumb")
+
+        symbol = parts.path.rsplit("/", 1)[-1]
+        module = dict(parse_qsl(parts.query))["modules"]
+        if symbol == "SPY" and module == "institutionOwnership":
+            body = {
+                "result": None,
+                "error": {
+                    "code": "Not Found",
+                    "description": "No fundamentals data found for any of "
+                    "the summaryTypes={}".format(module),
+                },
+            }
+        else:
+            body = {"result": [{module: self.MODULES[module]}], "error": None}
+        return response(
+            url, 200, "application/json", json.dumps({"quoteSummary": body})
+        )
+
+
+@override_settings(HTTP_CACHE_DIR="", RATE_LIMITS={})
+class SummaryTest(TestCase):
+    def setUp(self):
+        for symbol in ["AAPL", "SPY"]:
+            MyStock.objects.create(symbol=symbol)
+        session = FuturesSession(
+            max_workers=2, session=YahooTransport(FakeSummary())
+        )
+        patcher = mock.patch(
+            "stock.workers.batch.yahoo_session", return_value=session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fund_in_batch(self):
+        MySummary(["AAPL", "SPY"]).get()
+
+        stock = MyStock.objects.get(symbol="AAPL")
+        self.assertAlmostEqual(stock.top_ten_institution_ownership, 15)
+        self.assertAlmostEqual(stock.roa, 20)
+        self.assertEqual(stock.institution_count, 5000)
+
+        # w/o owners, what key stats says
+        stock = MyStock.objects.get(symbol="SPY")
+        self.assertAlmostEqual(stock.top_ten_institution_ownership, 0.6)
+        self.assertEqual(stock.institution_count, 5000)
+
+
+class HttpCacheTest(TestCase):
+    PRICES = (
+        "https://query1.finance.yahoo.com/v7/finance/download/AAPL"
+        "?period1={}&period2={}&interval=1d&events=history"
+    )
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        patcher = override_settings(HTTP_CACHE_DIR=self.root.name)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def entries(self):
+        return [
+            os.path.join(dirpath, x)
+            for dirpath, _, names in os.walk(self.root.name)
+            for x in names
+        ]
+
+    def test_prices_a_second_apart_share_an_entry(self):
+        now = int(time.time())
+        start = (now // DAY - 5) * DAY
+        http_cache.store(self.PRICES.format(start, now), 200, "text/csv", "a")
+
+        cached = http_cache.lookup(self.PRICES.format(start + 1, now + 1))
+        self.assertEqual(cached["body"], "a")
+        self.assertEqual(len(self.entries()), 1)
+
+        # a backfill isn't served a short download
+        backfill = self.PRICES.format(now - 50 * 365 * DAY, now + 1)
+        self.assertIsNone(http_cache.lookup(backfill))
+
+    def test_prune_stale_entries(self):
+        now = int(time.time())
+        http_cache.store(self.PRICES.format(0, now), 200, "text/csv", "a")
+        (stale,) = self.entries()
+        ago = now - settings.HTTP_CACHE_TTL["prices"] - 1
+        os.utime(stale, (ago, ago))
+
+        # not pruned by store, it was just done
+        with mock.patch.object(http_cache, "_pruned", now):
+            http_cache.store(self.PRICES.format(DAY, now), 200, "text/csv", "b")
+        self.assertEqual(len(self.entries()), 2)
+
+        self.assertEqual(http_cache.prune(), 1)
+        self.assertNotIn(stale, self.entries())
+
+
+# closes w/ ties, and opens, of fixed bars
+CLOSES = [10, 12, 12, 11, 13, 10, 10, 14, 9, 12, 12]
+OPENS = [11, 11, 12, 12, 12, 11, 10, 11, 13, 10, 12]
+
+
+def series(n, seed):
+    """Closes & opens of few distinct values, thus many ties."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(1, 6, n).tolist(), rng.integers(1, 6, n).tolist()
+
+
+def days_since(closes, keep):
+    """Per-row `MyStockHistorical.last_lower` & `last_better` of the
+    baseline: the latest earlier bar whose close satisfies `keep`,
+    then the count of bars from it up to me."""
+    vals = []
+    for i, me in enumerate(closes):
+        seen = [j for j in range(i) if keep(closes[j], me)]
+        vals.append(len(range(seen[-1], i)) if seen else 0)
+    return vals
+
+
+class DaysSinceTest(SimpleTestCase):
+    def test_fixed_series(self):
+        self.assertEqual(
+            analytics.days_since_lower(CLOSES).tolist(),
+            [0, 1, 2, 3, 1, 0, 0, 1, 0, 1, 2],
+        )
+        self.assertEqual(
+            analytics.days_since_higher(CLOSES).tolist(),
+            [0, 0, 0, 1, 0, 1, 2, 0, 1, 2, 3],
+        )
+
+    def test_same_as_per_row(self):
+        for seed in range(5):
+            closes, _ = series(200, seed)
+            self.assertEqual(
+                analytics.days_since_lower(closes).tolist(),
+                days_since(closes, lambda prev, me: prev < me),
+            )
+            self.assertEqual(
+                analytics.days_since_higher(closes).tolist(),
+                days_since(closes, lambda prev, me: prev > me),
+            )
+
+    def test_empty(self):
+        self.assertEqual(analytics.days_since_lower([]).tolist(), [])
+        self.assertEqual(analytics.days_since_higher([]).tolist(), [])
+
+
+def gain_probability(opens, closes):
+    """Per-row `MyStockHistorical.gain_probability` of the baseline:
+    % of later closes above my open."""
+    vals = []
+    for i, me in enumerate(opens):
+        later = closes[i + 1 :]
+        gains = [x for x in later if x > me]
+        vals.append(len(gains) / len(later) * 100.0 if later else 0)
+    return vals
+
+
+class GainProbabilityTest(TestCase):
+    def test_same_as_per_row(self):
+        self.assertEqual(
+            analytics.gain_probability(OPENS, CLOSES).tolist(),
+            gain_probability(OPENS, CLOSES),
+        )
+        for seed in range(5):
+            closes, opens = series(200, seed)
+            np.testing.assert_allclose(
+                analytics.gain_probability(opens, closes),
+                gain_probability(opens, closes),
+            )
+
+    def test_empty(self):
+        self.assertEqual(analytics.gain_probability([], []).tolist(), [])
+
+    def test_by_symbol(self):
+        # w/o a price cache, bars are read from DB
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        patcher = override_settings(PRICE_CACHE_DIR=root.name)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+        stock = MyStock.objects.create(symbol="AAPL")
+        ons = [date(2024, 1, 1) + timedelta(days=x) for x in range(len(CLOSES))]
+        MyStockHistorical.objects.bulk_create(
+            MyStockHistorical(
+                stock=stock,
+                on=on,
+                open_price=o,
+                close_price=c,
+                high_price=max(o, c),
+                low_price=min(o, c),
+                adj_close=c,
+                vol=1,
+            )
+            for on, o, c in zip(ons, OPENS, CLOSES)
+        )
+
+        self.assertEqual(
+            analytics.gain_probability_by_symbol("AAPL"),
+            dict(zip(ons, gain_probability(OPENS, CLOSES))),
+        )
+
+
+def bars_until_above(closes, thresholds):
+    """Per-row `MyStockHistorical.next_better` of the baseline: the
+    first later bar whose close is above my threshold, then the count
+    of bars up to it."""
+    vals = []
+    for i, me in enumerate(thresholds):
+        seen = [j for j in range(i + 1, len(closes)) if closes[j] > me]
+        vals.append(len(range(i + 1, seen[0] + 1)) if seen else 0)
+    return vals
+
+
+class BarsUntilAboveTest(SimpleTestCase):
+    def test_same_as_per_row(self):
+        self.assertEqual(
+            analytics.bars_until_above(CLOSES, OPENS).tolist(),
+            [1, 1, 2, 1, 3, 2, 1, 2, 0, 1, 0],
+        )
+        for seed in range(5):
+            closes, opens = series(200, seed)
+            self.assertEqual(
+                analytics.bars_until_above(closes, opens).tolist(),
+                bars_until_above(closes, opens),
+            )
+
+    def test_empty(self):
+        self.assertEqual(analytics.bars_until_above([], []).tolist(), [])
+
+
+def resample(ons, opens, highs, lows, closes, vols, interval):
+    """Bars of `interval`, a period at a time: (index of its last bar,
+    open, high, low, close, vol)."""
+    key = {
+        "1w": lambda x: x - timedelta(days=x.weekday()),
+        "1mo": lambda x: (x.year, x.month),
+        "1q": lambda x: (x.year, (x.month - 1) // 3),
+    }[interval]
+
+    periods = []
+    for i, on in enumerate(ons):
+        if periods and periods[-1][0] == key(on):
+            periods[-1][1].append(i)
+        else:
+            periods.append((key(on), [i]))
+
+    return [
+        (
+            rows[-1],
+            opens[rows[0]],
+            max(highs[x] for x in rows),
+            min(lows[x] for x in rows),
+            closes[rows[-1]],
+            sum(vols[x] for x in rows),
+        )
+        for _, rows in periods
+    ]
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets, a bucket at a time."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+    kept = [0]
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(x[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(y[avg_start:avg_end]) / (avg_end - avg_start)
+
+        best, best_area = None, -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs(
+                (x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a])
+            )
+            if area > best_area:
+                best, best_area = j, area
+        kept.append(best)
+        a = best
+
+    kept.append(n - 1)
+    return kept
+
+
+class ResampleTest(SimpleTestCase):
+    def setUp(self):
+        # weekdays across a quarter's end, w/ tied highs & lows
+        self.ons = [
+            x
+            for x in (date(2024, 3, 1) + timedelta(days=i) for i in range(70))
+            if x.weekday() < 5
+        ]
+        n = len(self.ons)
+        closes, opens = series(n, 0)
+        self.bars = (
+            self.ons,
+            opens,
+            [max(o, c) + 1 for o, c in zip(opens, closes)],
+            [min(o, c) - 1 for o, c in zip(opens, closes)],
+            closes,
+            list(range(n)),
+        )
+
+    def test_same_as_per_period(self):
+        for interval in analytics.INTERVALS:
+            vals = analytics.resample_ohlcv(*self.bars, interval)
+            self.assertEqual(
+                [tuple(x) for x in np.array(vals).T.tolist()],
+                [
+                    tuple(float(y) for y in x)
+                    for x in resample(*self.bars, interval)
+                ],
+            )
+
+    def test_weeks_start_on_monday(self):
+        ends = analytics.resample_ohlcv(*self.bars, "1w")[0]
+        self.assertTrue(all(self.ons[x].weekday() == 4 for x in ends[:-1]))
+
+    def test_empty(self):
+        vals = analytics.resample_ohlcv([], [], [], [], [], [], "1mo")
+        self.assertEqual([x.tolist() for x in vals], [[]] * 6)
+
+
+class LttbTest(SimpleTestCase):
+    def test_same_as_per_bucket(self):
+        for n, threshold, seed in [(102, 12, 0), (500, 50, 1), (1000, 37, 2)]:
+            # few distinct closes, thus tied areas
+            y, _ = series(n, seed)
+            x = list(range(n))
+            self.assertEqual(
+                analytics.lttb(x, y, threshold).tolist(),
+                lttb(x, y, threshold),
+            )
+
+    def test_keeps_peaks(self):
+        y = [0.0] * 100
+        y[37] = 10.0
+        y[71] = -10.0
+        kept = analytics.lttb(range(100), y, 10).tolist()
+        self.assertEqual(len(kept), 10)
+        self.assertEqual([kept[0], kept[-1]], [0, 99])
+        self.assertIn(37, kept)
+        self.assertIn(71, kept)
+
+    def test_too_few_points(self):
+        self.assertEqual(analytics.lttb([], [], 10).tolist(), [])
+        self.assertEqual(
+            analytics.lttb(range(5), range(5), 10).tolist(), [0, 1, 2, 3, 4]
+        )
+
+
+class MarketTest(SimpleTestCase):
+    # NYSE's published holidays
+    HOLIDAYS = {
+        # New Year's Day on a Saturday isn't observed
+        2022: [
+            (1, 17),
+            (2, 21),
+            (4, 15),
+            (5, 30),
+            (6, 20),
+            (7, 4),
+            (9, 5),
+            (11, 24),
+            (12, 26),
+        ],
+        2023: [
+            (1, 2),
+            (1, 16),
+            (2, 20),
+            (4, 7),
+            (5, 29),
+            (6, 19),
+            (7, 4),
+            (9, 4),
+            (11, 23),
+            (12, 25),
+        ],
+        # July 4th on a Saturday is observed on Friday
+        2020: [
+            (1, 1),
+            (1, 20),
+            (2, 17),
+            (4, 10),
+            (5, 25),
+            (7, 3),
+            (9, 7),
+            (11, 26),
+            (12, 25),
+        ],
+    }
+
+    def at(self, *args):
+        return market.TZ.localize(datetime(*args))
+
+    def test_holidays(self):
+        for year, days in self.HOLIDAYS.items():
+            self.assertEqual(
+                market.holidays(year), {date(year, *x) for x in days}
+            )
+
+    def test_early_closes(self):
+        for day in [date(2023, 7, 3), date(2023, 11, 24), date(2019, 12, 24)]:
+            self.assertEqual(
+                market.session(day),
+                (
+                    self.at(day.year, day.month, day.day, 9, 30),
+                    self.at(day.year, day.month, day.day, 13, 0),
+                ),
+            )
+
+        # a regular day, and July 3rd that is a holiday itself
+        self.assertEqual(
+            market.session(date(2023, 7, 5))[1], self.at(2023, 7, 5, 16, 0)
+        )
+        self.assertIsNone(market.session(date(2020, 7, 3)))
+
+    def test_is_open(self):
+        self.assertFalse(market.is_open(self.at(2023, 11, 24, 13, 30)))
+        self.assertTrue(market.is_open(self.at(2023, 11, 24, 12, 59)))
+        self.assertFalse(market.is_open(self.at(2023, 11, 25, 12, 0)))
+
+        # at the open, but not at the close
+        self.assertTrue(market.is_open(self.at(2023, 11, 27, 9, 30)))
+        self.assertFalse(market.is_open(self.at(2023, 11, 27, 16, 0)))
+
+        # same instant, in UTC
+        self.assertTrue(
+            market.is_open(self.at(2023, 11, 27, 15, 0).astimezone(pytz.utc))
+        )
+
+    def test_last_session(self):
+        # Monday before the open, after Thanksgiving weekend
+        opened, closed = market.last_session(self.at(2023, 11, 27, 8, 0))
+        self.assertEqual(opened, self.at(2023, 11, 24, 9, 30))
+        self.assertEqual(closed, self.at(2023, 11, 24, 13, 0))
+
+        # Saturday after Good Friday
+        opened, _ = market.last_session(self.at(2023, 4, 8, 12, 0))
+        self.assertEqual(opened, self.at(2023, 4, 6, 9, 30))
+
+
+class StalePricesTest(TestCase):
+    def stock(self, symbol, fetched, last_bar=date(2023, 11, 24)):
+        return MyStock.objects.create(
+            symbol=symbol, prices_fetched=fetched, last_bar=last_bar
+        )
+
+    def stale(self, now):
+        return set(stale_prices(now).values_list("symbol", flat=True))
+
+    def test_while_open(self):
+        now = market.TZ.localize(datetime(2023, 11, 27, 11, 0))
+        self.stock("NEW", None)
+        self.stock("OLD", now - timedelta(minutes=20))
+        self.stock("NOW", now - timedelta(minutes=5))
+
+        # w/o a bar for long, once a day
+        self.stock("DEAD", now - timedelta(hours=2), date(2023, 1, 3))
+        self.stock("GONE", now - timedelta(days=2), date(2023, 1, 3))
+
+        self.assertEqual(self.stale(now), {"NEW", "OLD", "GONE"})
+
+    def test_weekend(self):
+        # Friday closed early, at 13:00
+        now = market.TZ.localize(datetime(2023, 11, 25, 12, 0))
+        self.stock(
+            "SETTLED", market.TZ.localize(datetime(2023, 11, 24, 13, 40))
+        )
+        self.stock("EARLY", market.TZ.localize(datetime(2023, 11, 24, 13, 10)))
+
+        self.assertEqual(self.stale(now), {"EARLY"})
+
+
+@override_settings(REDIS_HOST=None, RATE_LIMITS={"yahoo": (60, 2)})
+class RateLimitTest(SimpleTestCase):
+    """A bucket of 2 tokens, refilled at one a second."""
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("fin.rate_limit.time")
+        clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(rate_limit._local.clear)
+
+        clock.monotonic.side_effect = lambda: self.now
+        self.sleep = clock.sleep
+
+    def waits(self):
+        waits = [x.args[0] for x in self.sleep.call_args_list]
+        self.sleep.reset_mock()
+        return waits
+
+    def test_burst_then_rate(self):
+        # a burst of capacity is free, then each waits its turn
+        for _ in range(5):
+            rate_limit.acquire("yahoo")
+        self.assertEqual(self.waits(), [1.0, 2.0, 3.0])
+
+        # refilled no more than capacity
+        self.now += 60
+        for _ in range(3):
+            rate_limit.acquire("yahoo")
+        self.assertEqual(self.waits(), [1.0])
+
+    def test_many_tokens(self):
+        rate_limit.acquire("yahoo", 5)
+        self.assertEqual(self.waits(), [3.0])
+
+        self.now += 1
+        rate_limit.acquire("yahoo", 0)
+        rate_limit.acquire("yahoo")
+        self.assertEqual(self.waits(), [3.0])
+
+    def test_no_limit(self):
+        for _ in range(5):
+            rate_limit.acquire("example.com")
+        self.assertEqual(self.waits(), [])
+
+
+def dupont_model(stock):
+    """`MyStock.dupont_model` of the baseline, a query per balance
+    sheet."""
+    vals = []
+    for b in stock.balances.all().order_by("on"):
+        incomes = stock.incomes.filter(on__lte=b.on).order_by("-on")
+        if not incomes:
+            continue
+
+        i = incomes[0]
+        if b.total_assets:
+            turnover = i.total_revenue / b.total_assets
+        else:
+            turnover = 0
+        vals.append(
+            {
+                "on": b.on,
+                "net_profit_margin": i.net_income_to_revenue,
+                "asset_turnover": turnover * 100,
+                "equity_multiplier": b.equity_multiplier,
+                "roe": i.net_income_to_revenue * turnover * b.equity_multiplier,
+                "revenue": i.total_revenue,
+                "assets": b.total_assets,
+                "debts": b.total_debt,
+                "equity": b.stockholders_equity,
+            }
+        )
+    return vals
+
+
+def dupont_roe(stock):
+    """`MyStock.dupont_roe` of the baseline, w/ aggregate queries."""
+    if not stock.balances.all():
+        return 0
+
+    avgs = stock.balances.filter(stockholders_equity__gt=0).aggregate(
+        Avg("total_assets"), Avg("stockholders_equity")
+    )
+    if not all(avgs.values()):
+        return 0
+    equity_multiplier = (
+        avgs["total_assets__avg"] / avgs["stockholders_equity__avg"]
+    )
+
+    last_reporting_date = stock.balances.order_by("-on")[0].on
+    incomes = stock.incomes.filter(on__lte=last_reporting_date).order_by("on")
+    if not incomes:
+        return 0
+
+    last_income = incomes.last()
+    turnover = last_income.total_revenue / avgs["total_assets__avg"]
+    return last_income.net_income_to_revenue * turnover * equity_multiplier
+
+
+class DupontTest(TestCase):
+    def setUp(self):
+        self.stock = MyStock.objects.create(symbol="AAPL")
+
+    def add(self, balances, incomes):
+        for on, assets, equity, debt in balances:
+            BalanceSheet.objects.create(
+                stock=self.stock,
+                on=on,
+                total_assets=assets,
+                stockholders_equity=equity,
+                total_debt=debt,
+            )
+        for on, net_income, revenue in incomes:
+            IncomeStatement.objects.create(
+                stock=self.stock,
+                on=on,
+                net_income=net_income,
+                total_revenue=revenue,
+            )
+
+    def assertSameAsPerRow(self):
+        balances, incomes = dupont.statements([self.stock])[self.stock.id]
+
+        vals = dupont.model(balances, incomes)
+        expected = dupont_model(self.stock)
+        self.assertEqual(len(vals), len(expected))
+        for val, x in zip(vals, expected):
+            self.assertEqual(val.keys(), x.keys())
+            for key in x:
+                self.assertAlmostEqual(val[key], x[key], msg=key)
+
+        self.assertAlmostEqual(
+            dupont.roe(balances, incomes), dupont_roe(self.stock)
+        )
+
+    def test_same_as_per_row(self):
+        self.add(
+            [
+                # before any income statement, thus left out
+                (date(2022, 12, 31), 300, 100, 50),
+                # same day as an income statement
+                (date(2023, 3, 31), 320, 110, 60),
+                # income statements are later than balance sheets
+                (date(2023, 6, 30), 350, 120, 70),
+                # negative equity
+                (date(2023, 9, 30), 340, -10, 80),
+                (date(2023, 12, 31), 0, 0, 0),
+            ],
+            [
+                (date(2023, 3, 31), 20, 100),
+                (date(2023, 7, 2), -5, 90),
+                (date(2023, 9, 29), 30, 120),
+                (date(2023, 10, 3), 10, 0),
+            ],
+        )
+        self.assertSameAsPerRow()
+
+    def test_incomes_after_balance_sheets(self):
+        self.add(
+            [(date(2023, 3, 31), 320, 110, 60)],
+            [(date(2023, 4, 30), 20, 100)],
+        )
+        self.assertSameAsPerRow()
+        balances, incomes = dupont.statements([self.stock])[self.stock.id]
+        self.assertEqual(dupont.roe(balances, incomes), 0)
+
+    def test_empty(self):
+        self.assertSameAsPerRow()
+        balances, incomes = dupont.statements([self.stock])[self.stock.id]
+        self.assertEqual(dupont.model(balances, incomes), [])
+        self.assertEqual(dupont.roe(balances, incomes), 0)
@@ -0,0 +1,366 @@
+import logging
+import threading
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from requests import Request
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests_futures.sessions import FuturesSession
+
+from fin import http_cache
+from fin import http_fixtures
+from fin.rate_limit import acquire
+from fin.tor_handler import pool_stats
+from stock.models import MyStock
+from yahooquery import Ticker
+from yahooquery.session_management import initialize_session
+
+logger = logging.getLogger("stock")
+
+# symbols per Ticker, ie. per round of Yahoo requests
+BATCH_SIZE = 50
+
+M = 10 ** 6
+B = 10 ** 9
+
+# where a Ticker gets its crumb
+CRUMB_PATH = "/v1/test/getcrumb"
+
+# yahooquery session shared by Tickers of this process
+_session = None
+
+
+def get_stocks(symbols):
+    """Stocks of one or a list of symbols.
+
+    Return
+    ------
+      dict: {symbol: MyStock}
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+
+    stocks = {x.symbol: x for x in MyStock.objects.filter(symbol__in=symbols)}
+    for symbol in set(symbols) - set(stocks):
+        logger.error("{}: stock not found".format(symbol))
+    return stocks
+
+
+def response(url, status, content_type, body):
+    """A requests Response of a body we already have."""
+    r = Response()
+    r.status_code = status
+    r.headers = CaseInsensitiveDict({"Content-Type": content_type})
+    r._content = body.encode("utf-8")
+    r.encoding = "utf-8"
+    r.url = url
+    return r
+
+
+class YahooTransport:
+    """Where a yahooquery session actually sends its requests.
+
+    yahooquery makes requests w/ a curl_cffi session, and w/
+    `asynchronous=True` a FuturesSession calls that inner session's
+    `request` directly. So requests adapters mounted on either are
+    never used. Instead, this takes the inner session's place.
+
+    A fresh response is served from the on-disk cache, see
+    `fin.http_cache`. Only requests that do go to Yahoo take a token
+    from the rate limiter, so a cached sweep doesn't wait on it. They
+    go to the stand-in instead if there is one, and are recorded if
+    we are recording, see `fin.http_fixtures`.
+
+    Every Ticker asks Yahoo for a crumb when it's created. The crumb
+    goes w/ the session's cookies, thus once we have one it's handed
+    to every later Ticker w/o a request.
+
+    curl keeps no urllib3 pools to count connections in, so I count
+    requests per host, and the local addresses they were sent from,
+    one per connection.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.crumb = None
+        self.lock = threading.Lock()
+
+        # {host: number of requests}, {host: set of (local ip, port)}
+        self.requests = {}
+        self.connections = {}
+
+    def __getattr__(self, name):
+        # eg. cookies & headers of the session
+        return getattr(self.session, name)
+
+    def request(self, method, url, params=None, **kwargs):
+        url = Request(method, url, params=params).prepare().url
+        if urlparse(url).path == CRUMB_PATH:
+            return self._crumb(method, url, **kwargs)
+
+        cached = http_cache.lookup(url)
+        if cached:
+            return response(
+                url,
+                cached["status"],
+                cached["content_type"] or "text/plain",
+                cached["body"],
+            )
+
+        r = self._send(method, url, **kwargs)
+        if r.status_code == 401:
+            # crumb has expired, the next Ticker will get a new one
+            with self.lock:
+                self.crumb = None
+        http_cache.store(
+            url, r.status_code, r.headers.get("Content-Type"), r.text
+        )
+        return r
+
+    def _send(self, method, url, **kwargs):
+        # wait for my turn, shared w/ other workers
+        acquire(urlparse(url).netloc)
+
+        r = self.session.request(
+            method, http_fixtures.standin_url(url), **kwargs
+        )
+        r.url = url
+
+        host = urlparse(url).netloc
+        local = (getattr(r, "local_ip", ""), getattr(r, "local_port", 0))
+        with self.lock:
+            self.requests[host] = self.requests.get(host, 0) + 1
+            self.connections.setdefault(host, set()).add(local)
+
+        http_fixtures.record(
+            url, r.status_code, r.headers.get("Content-Type"), r.text
+        )
+        return r
+
+    def pool_stats(self):
+        """Connection reuse of requests sent, see `pool_stats`."""
+        adapters = getattr(self.session, "adapters", None)
+        if adapters is not None:
+            # a requests session, eg. of the stand-in, has its pools
+            stats = {}
+            for adapter in adapters.values():
+                manager = getattr(adapter, "poolmanager", None)
+                if manager is not None:
+                    stats.update(pool_stats(manager))
+            return stats
+
+        stats = {}
+        with self.lock:
+            for host, num in self.requests.items():
+                connections = len(self.connections[host])
+                stats[host] = {
+                    "requests": num,
+                    "connections": connections,
+                    "reuse": max(0, num - connections) / num * 100,
+                }
+        return stats
+
+    def _crumb(self, method, url, **kwargs):
+        with self.lock:
+            crumb = self.crumb
+        if crumb:
+            return response(url, 200, "text/plain", crumb)
+
+        r = self._send(method, url, **kwargs)
+        if r.status_code == 200 and r.text and "<html>" not in r.text:
+            with self.lock:
+                self.crumb = r.text
+        return r
+
+
+def yahoo_session():
+    """yahooquery session shared by all tasks of this process.
+
+    A new Ticker would otherwise open its own session, paying TCP+TLS
+    setup plus yahooquery's cookie & crumb handshake. So I set up a
+    session once, put a `YahooTransport` in it, and hand it to every
+    Ticker. It's created when a celery worker process starts, or on
+    first use.
+
+    Its Yahoo traffic goes through the on-disk cache, see
+    `fin.http_cache`. W/ a stand-in of Yahoo, there are no cookies
+    to set up, and the session is routed to it, see `fin.http_fixtures`.
+    """
+    global _session
+    if _session is None:
+        if settings.YAHOO_STANDIN:
+            standin = Session()
+            standin.mount(
+                settings.YAHOO_STANDIN,
+                HTTPAdapter(pool_maxsize=settings.HTTP_POOL_SIZE),
+            )
+            session = FuturesSession(
+                max_workers=settings.HTTP_POOL_SIZE, session=standin
+            )
+        else:
+            session = initialize_session(
+                timeout=15,
+                asynchronous=True,
+                max_workers=settings.HTTP_POOL_SIZE,
+            )
+
+        # a sync session, or one w/o an inner session, we'd miss
+        inner = getattr(session, "session", None)
+        if not hasattr(inner, "request"):
+            raise TypeError("can't intercept {}".format(type(session)))
+        session.session = YahooTransport(inner)
+        _session = session
+    return _session
+
+
+def yahoo_pool_stats():
+    """Connection reuse of the yahooquery session, see `pool_stats`."""
+    if _session is None:
+        return {}
+    return _session.session.pool_stats()
+
+
+def get_ticker(symbols):
+    """One Ticker for all symbols.
+
+    Yahoo requests of the symbols are made concurrently, over the
+    connections of this process's session.
+    """
+    return Ticker(list(symbols), asynchronous=True, session=yahoo_session())
+
+
+def _has_failed(data):
+    # same test yahooquery uses to decide it can't make a data frame
+    return isinstance(data, str) or bool(data and data[0].get("description"))
+
+
+def financials_by_symbol(symbols, fetch, kind=None):
+    """Fetch a financials data frame of many symbols, split by symbol.
+
+    yahooquery puts all symbols into one data frame indexed by
+    symbol. However, if _any_ symbol has no data, we get the raw
+    dict instead. Thus I log those failed ones and fetch the rest
+    again.
+
+    Args
+    ----
+      :param: symbols, list of str
+      :param: fetch, callable(Ticker) -> data frame, eg.
+        `lambda s: s.balance_sheet(frequency="q")`
+      :param: kind, str, eg. "balance_sheet". If given, a symbol's
+        data frame is skipped if it's the same as what we persisted
+        last time.
+
+    Return
+    ------
+      generator of (symbol, data frame)
+    """
+    symbols = list(symbols)
+    if not symbols:
+        return
+
+    df = fetch(get_ticker(symbols))
+
+    if isinstance(df, str):
+        # none of them has data
+        logger.error(df)
+        return
+
+    if isinstance(df, dict):
+        failed = [x for x in symbols if _has_failed(df.get(x))]
+        if not failed:
+            # not about any symbol, eg. {"error": "HTTP 404 ..."}
+            logger.error("{}: {}".format(symbols, df))
+            return
+
+        for symbol in failed:
+            logger.error("{}: {}".format(symbol, df[symbol]))
+
+        rest = [x for x in symbols if x not in failed]
+        yield from financials_by_symbol(rest, fetch, kind)
+        return
+
+    if "unavailable" in df or "error" in df:
+        logger.error("{}: {}".format(symbols, df))
+        return
+
+    for symbol, group in df.groupby(level=0, sort=False):
+        content_hash = http_cache.digest(group.to_csv())
+        if kind and http_cache.is_persisted(kind, symbol, content_hash):
+            logger.debug("[{}] {} unchanged".format(symbol, kind))
+            continue
+
+        yield symbol, group
+
+        # resumed only after caller has persisted it
+        if kind:
+            http_cache.mark_persisted(kind, symbol, content_hash)
+
+
+def upsert_statements(model, stock, df, mapping, scale=True):
+    """Save a symbol's statement data frame, one record per `asOfDate`.
+
+    Data frame columns are mapped to model fields all at once instead
+    of row by row. Then records I already have are updated and the
+    rest are created, so it's a few queries per symbol no matter how
+    many quarters there are.
+
+    Args
+    ----
+      :param: model, statement model, eg. `BalanceSheet`
+      :param: stock, MyStock
+      :param: df, data frame of this stock
+      :param: mapping, {model field: data frame column}
+      :param: scale, if True, large numbers are converted to B
+
+    Return
+    ------
+      int: number of records saved.
+    """
+
+    # rows w/o any of my columns belong to another statement, eg. in
+    # a frame of all statements, see `MyStatements`
+    columns = [x for x in mapping.values() if x in df.columns]
+    df = df.dropna(subset=columns, how="all") if columns else df.iloc[:0]
+
+    # a date can have both 3M & TTM rows, last one wins
+    df = df.drop_duplicates("asOfDate", keep="last")
+    ons = [x.date() for x in df["asOfDate"]]
+
+    # missing column is 0, and DB doesn't like NaN
+    fields = list(mapping)
+    vals = (
+        df.reindex(columns=list(mapping.values()))
+        .apply(pd.to_numeric, errors="coerce")
+        .fillna(0)
+        .to_numpy(dtype=float)
+    )
+
+    # if a value is a large number, it's unlikely a rate, eg. tax
+    # rate, thus convert it to B.
+    if scale:
+        vals = np.where(np.abs(vals) > M, vals / B, vals)
+
+    existing = dict(
+        model.objects.filter(stock=stock, on__in=ons).values_list("on", "id")
+    )
+    updates = []
+    creates = []
+    for on, row in zip(ons, vals.tolist()):
+        i = model(
+            id=existing.get(on), stock=stock, on=on, **dict(zip(fields, row))
+        )
+        if i.id:
+            updates.append(i)
+        else:
+            creates.append(i)
+
+    model.objects.bulk_update(updates, fields)
+    model.objects.bulk_create(creates)
+    return len(ons)
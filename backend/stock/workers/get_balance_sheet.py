@@ -1,33 +1,28 @@
 import logging
 
-import pandas as pd
-
 from stock.models import BalanceSheet
-from stock.models import MyStock
-from yahooquery import Ticker
+from stock.workers.batch import financials_by_symbol
+from stock.workers.batch import get_stocks
+from stock.workers.batch import upsert_statements
 
 logger = logging.getLogger("stock")
 
-M = 10 ** 6
-B = 10 ** 9
-
 
 class MyBalanceSheet:
-    def __init__(self, symbol):
-        self.stock = MyStock.objects.get(symbol=symbol)
+    def __init__(self, symbols):
+        # a symbol, or a list of symbols to fetch in one go
+        self.stocks = get_stocks(symbols)
 
     def get(self):
-        s = Ticker(self.stock.symbol, timeout=15)
-
-        # all numbers convert to million
-        df = s.balance_sheet(frequency="q")
-        if "unavailable" in df or "error" in df:
-            logger.error("{}: {}".format(self.stock.symbol, df))
-            return
-
-        # DB doesn't like NaN
-        df = df.where(pd.notnull(df), 0)
+        for symbol, df in financials_by_symbol(
+            self.stocks,
+            lambda s: s.balance_sheet(frequency="q"),
+            "balance_sheet",
+        ):
+            self.persist(self.stocks[symbol], df)
 
+    @staticmethod
+    def persist(stock, df):
         # mapping between model field (left) and data json key (right)
         mapping = {
             "ap": "AccountsPayable",
@@ -93,25 +88,4 @@ class MyBalanceSheet:
             "share_issued": "ShareIssued",
         }
 
-        # enumerate data frame
-        for row in df.itertuples(index=False):
-            i, created = BalanceSheet.objects.get_or_create(
-                stock=self.stock, on=row.asOfDate.date()
-            )
-
-            for key, val in mapping.items():
-                try:
-                    # value can be None
-                    tmp = float(getattr(row, val))
-                except AttributeError:
-                    tmp = 0
-
-                # if tmp is a large number, it's unlikely a rate,
-                # eg. tax rate, thus convert it to B.
-                if abs(tmp) > M:
-                    tmp = tmp / B
-
-                # set value
-                setattr(i, key, tmp)
-
-            i.save()
+        upsert_statements(BalanceSheet, stock, df, mapping)
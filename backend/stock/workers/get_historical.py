@@ -1,22 +1,48 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-import csv
 import logging
+import math
 from datetime import datetime as dt
-from decimal import Decimal
-from decimal import InvalidOperation
-from functools import reduce
 from io import StringIO
 
+import pandas as pd
 from dateutil.relativedelta import relativedelta
+from django.db.models import Max
+from django.utils import timezone
 
+from fin import http_cache
+from stock import price_cache
+from stock import snapshot
+from stock.analytics import update_historical_analytics
 from stock.models import MySector
 from stock.models import MyStock
 from stock.models import MyStockHistorical
 
 logger = logging.getLogger("stock")
 
+# days before the latest bar to download again, to pick up corrections
+OVERLAP_DAYS = 7
+
+PRICE_FIELDS = [
+    "open_price",
+    "high_price",
+    "low_price",
+    "close_price",
+    "adj_close",
+]
+
+# model field: CSV column
+COLUMNS = {
+    "on": "Date",
+    "open_price": "Open",
+    "high_price": "High",
+    "low_price": "Low",
+    "close_price": "Close",
+    "adj_close": "Adj Close",
+    "vol": "Volume",
+}
+
 
 class MyStockHistoricalYahoo:
     def __init__(self, handler):
@@ -43,18 +69,28 @@ class MyStockHistoricalYahoo:
         # Get stock and its existing historicals
         stock, created = MyStock.objects.get_or_create(symbol=symbol)
 
-        his = [
-            x.isoformat()
-            for x in MyStockHistorical.objects.filter(stock=stock).values_list(
-                "on", flat=True
-            )
-        ]
-
         # Read Yahoo api to get data
         # https://code.google.com/p/yahoo-finance-managed/wiki/csvHistQuotesDownload
         unix_origin = dt(1970, 1, 1)
         now = dt.now()
-        ago = now + relativedelta(years=-50)  # 50 years
+
+        # Only ask for bars since the latest one I have, w/ a few days
+        # of overlap in case Yahoo has corrected them.
+        latest = stock.historicals.aggregate(Max("on"))["on__max"]
+        if latest:
+            ago = dt.combine(latest, dt.min.time()) + relativedelta(
+                days=-OVERLAP_DAYS
+            )
+        else:
+            ago = now + relativedelta(years=-50)  # 50 years
+
+        # existing bars in the overlap: {date: bar}
+        his = {
+            x.on: x
+            for x in MyStockHistorical.objects.filter(
+                stock=stock, on__gte=ago.date()
+            )
+        }
 
         # https://query1.finance.yahoo.com/v7/finance/download/AMZN?period1=863654400&period2=1607990400&interval=1d&events=history&includeAdjustedClose=true
 
@@ -68,86 +104,133 @@ class MyStockHistoricalYahoo:
         logger.debug(url)
         logger.info("reading {} historicals".format(symbol))
         content = self.http_handler.request(url)
+        if content:
+            MyStock.objects.filter(id=stock.id).update(
+                prices_fetched=timezone.now()
+            )
+
+        # same as what I persisted last time, nothing new
+        content_hash = http_cache.digest(content or "")
+        if http_cache.is_persisted("prices", symbol, content_hash):
+            logger.debug("[{}] prices unchanged".format(symbol))
+            return
 
         # Parse data to update stock historicals
-        f = StringIO(content)
+        bars = self._parse(symbol, content)
+
+        fields = PRICE_FIELDS + ["vol"]
         records = []
-        for cnt, vals in enumerate(csv.reader(f)):
-            if not self._are_vals_valid(symbol, vals):
-                logger.debug("invalid vals: {}".format(vals))
+        corrected = []
+        for i, on in enumerate(bars["on"]):
+            prices = {key: bars[key][i] for key in fields}
+
+            existing = his.get(on)
+            if existing:
+                # we already have this, but has it been corrected?
+                if any(
+                    not math.isclose(getattr(existing, key), val)
+                    for key, val in prices.items()
+                ):
+                    for key, val in prices.items():
+                        setattr(existing, key, val)
+                    corrected.append(existing)
                 continue
 
-            # stamp = [int(v) for v in vals[0].split('-')]
-            # date_stamp = dt(year=stamp[0], month=stamp[1], day=stamp[2])
-            date_stamp = dt.strptime(vals[0], "%Y-%m-%d")
-            if date_stamp.date().isoformat() in his:
-                # logger.debug('already have this')
-                continue  # we already have these
-            else:
-                open_p, high_p, low_p, close_p, adj_p = map(
-                    self._convert_to_decimal, vals[1:6]
-                )
-
-                if vals[6] is None or vals[6] == "null":
-                    vol = -1
-                else:
-                    vol = int(vals[6]) / 1000.0
-
-                # Create an obj and wait for bulk creation
-                h = MyStockHistorical(
-                    stock=stock,
-                    on=date_stamp,
-                    open_price=open_p,
-                    high_price=high_p,
-                    low_price=low_p,
-                    close_price=close_p,
-                    vol=vol,
-                    adj_close=adj_p,
-                )
-                records.append(h)
-
-                # bulk creation
-                if len(records) >= 1000:
-                    MyStockHistorical.objects.bulk_create(records)
-                    records = []
-
-        # whatever left in records are to be saved to DB
-        if records:
-            MyStockHistorical.objects.bulk_create(records)
+            records.append(MyStockHistorical(stock=stock, on=on, **prices))
+
+        # new bars in one go
+        cnt_created = len(records)
+        MyStockHistorical.objects.bulk_create(records, batch_size=1000)
+
+        if bars["on"] and (latest is None or bars["on"][-1] > latest):
+            MyStock.objects.filter(id=stock.id).update(last_bar=bars["on"][-1])
+
+        if corrected:
+            logger.info(
+                "[{}] {} bars corrected by Yahoo".format(symbol, len(corrected))
+            )
+            MyStockHistorical.objects.bulk_update(corrected, fields)
+
+        # refresh analytics if we have new bars, or bars that have
+        # never been computed
+        if (
+            cnt_created
+            or corrected
+            or stock.historicals.filter(last_lower__isnull=True).exists()
+        ):
+            update_historical_analytics(stock.id)
+
+        # columnar cache for lookups by web & workers
+        if (
+            cnt_created
+            or corrected
+            or price_cache.open_series(stock.id) is None
+        ):
+            price_cache.refresh(stock.id)
+
+        # list-level values read off the latest bar
+        if cnt_created or corrected:
+            snapshot.refresh(stock.id)
+
+        if content:
+            http_cache.mark_persisted("prices", symbol, content_hash)
 
         # persist
         logger.debug("[%s] complete" % symbol)
 
-    def _convert_to_decimal(self, val):
-        try:
-            me = Decimal(val)
-        except InvalidOperation:
-            me = Decimal(-1)
-        return me
+    def _parse(self, symbol, content):
+        """Parse Yahoo CSV into arrays, one per column.
 
-    def _are_vals_valid(self, symbol, vals):
-        """Check vals for some edge conditions.
+        Rows w/ an invalid date or a missing price are dropped, eg.
+        Yahoo gives "null" prices on some days. A missing volume is
+        -1.
 
-        Returns:
-          :bool: TRUE when vals are good for parsing.
+        Return
+        ------
+          dict: {"on": list of date, field: list of float}, sorted
+          by date.
         """
-        if not vals:
-            # protect from blank line or invalid symbol, eg. China
-            # stock symbols logger.debug('not vals')
-            logger.error("vals are empty or None")
-            return False
-
-        if not reduce(lambda x, y: x and y, vals):
-            # any empty string, None will be skipped
-            logger.error("not all columns have value")
-            return False
-
-        if len(vals) != 7:
-            logger.error("[%s] error, %d" % (symbol, len(vals)))
-            return False
-
-        elif "Adj" in vals[-2]:
-            # this is to skip the column header line
-            return False
-
-        return True
+        empty = {x: [] for x in ["on"] + PRICE_FIELDS + ["vol"]}
+        if not content:
+            logger.error("[{}] no data".format(symbol))
+            return empty
+
+        try:
+            df = pd.read_csv(
+                StringIO(content), na_values=["null"], skipinitialspace=True
+            )
+        except (ValueError, pd.errors.ParserError):
+            logger.exception("[{}] invalid csv".format(symbol))
+            return empty
+
+        if not set(COLUMNS.values()).issubset(df.columns):
+            # protect from invalid symbol, eg. China stock symbols,
+            # where we get an error message instead
+            logger.error("[{}] invalid csv: {}".format(symbol, content[:100]))
+            return empty
+
+        bars = pd.DataFrame(
+            {
+                key: pd.to_numeric(df[col], errors="coerce")
+                for key, col in COLUMNS.items()
+                if key != "on"
+            }
+        )
+        bars["on"] = pd.to_datetime(
+            df["Date"], format="%Y-%m-%d", errors="coerce"
+        )
+
+        valid = bars[["on"] + PRICE_FIELDS].notna().all(axis=1)
+        if not valid.all():
+            logger.debug(
+                "[{}] dropped {} invalid rows".format(symbol, (~valid).sum())
+            )
+        bars = bars[valid].assign(vol=(bars["vol"] / 1000.0).fillna(-1))
+
+        # if a date shows twice, last one wins
+        bars = bars.drop_duplicates("on", keep="last").sort_values("on")
+
+        vals = {"on": bars["on"].dt.date.tolist()}
+        for key in PRICE_FIELDS + ["vol"]:
+            vals[key] = bars[key].to_numpy(dtype=float).tolist()
+        return vals
@@ -1,33 +1,28 @@
 import logging
 
-import pandas as pd
-
 from stock.models import IncomeStatement
-from stock.models import MyStock
-from yahooquery import Ticker
+from stock.workers.batch import financials_by_symbol
+from stock.workers.batch import get_stocks
+from stock.workers.batch import upsert_statements
 
 logger = logging.getLogger("stock")
 
-M = 10 ** 6
-B = 10 ** 9
-
 
 class MyIncomeStatement:
-    def __init__(self, symbol):
-        self.stock = MyStock.objects.get(symbol=symbol)
+    def __init__(self, symbols):
+        # a symbol, or a list of symbols to fetch in one go
+        self.stocks = get_stocks(symbols)
 
     def get(self):
-        s = Ticker(self.stock.symbol, timeout=15)
-
-        # all numbers convert to million
-        df = s.income_statement(frequency="q")
-        if "unavailable" in df or "error" in df:
-            logger.error("{}: {}".format(self.stock.symbol, df))
-            return
-
-        # DB doesn't like NaN
-        df = df.where(pd.notnull(df), 0)
-
+        for symbol, df in financials_by_symbol(
+            self.stocks,
+            lambda s: s.income_statement(frequency="q"),
+            "income_statement",
+        ):
+            self.persist(self.stocks[symbol], df)
+
+    @staticmethod
+    def persist(stock, df):
         mapping = {
             "basic_eps": "BasicEPS",
             "ebit": "EBIT",
@@ -62,24 +57,4 @@ class MyIncomeStatement:
             "reconciled_depreciation": "ReconciledDepreciation",
             "net_income_from_continuing_operation_net_minority_interest": "NetIncomeFromContinuingOperationNetMinorityInterest",
         }
-        # enumerate data frame
-        for row in df.itertuples(index=False):
-            i, created = IncomeStatement.objects.get_or_create(
-                stock=self.stock, on=row.asOfDate.date()
-            )
-
-            for key, val in mapping.items():
-                try:
-                    tmp = float(getattr(row, val))
-                except AttributeError:
-                    tmp = 0
-
-                # if tmp is a large number, it's unlikely a rate,
-                # eg. tax rate, thus convert it to B.
-                if abs(tmp) > M:
-                    tmp = tmp / B
-
-                # set value
-                setattr(i, key, tmp)
-
-            i.save()
+        upsert_statements(IncomeStatement, stock, df, mapping)
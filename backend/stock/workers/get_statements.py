@@ -0,0 +1,65 @@
+import logging
+
+from stock import snapshot
+from stock.workers.batch import financials_by_symbol
+from stock.workers.batch import get_stocks
+from stock.workers.get_balance_sheet import MyBalanceSheet
+from stock.workers.get_cash_flow_statement import MyCashFlowStatement
+from stock.workers.get_income_statement import MyIncomeStatement
+from stock.workers.get_valuation_ratio import MyValuationRatio
+from yahooquery.constants import FUNDAMENTALS_OPTIONS
+
+logger = logging.getLogger("stock")
+
+# Yahoo's fundamentals timeseries of the three statements
+STATEMENT_TYPES = [
+    x
+    for kind in ["balance_sheet", "income_statement", "cash_flow"]
+    for x in FUNDAMENTALS_OPTIONS[kind]
+]
+
+
+class MyStatements:
+    """All statements of a symbol from two Yahoo requests.
+
+    Balance sheet, income & cash flow are all Yahoo's fundamentals
+    timeseries, so I ask for all of them at once and hand the data
+    frame to each statement to persist its columns.
+
+    Valuation measures are timeseries too, but yahooquery pivots
+    statements by currency, and valuation measures have none, so
+    they'd be dropped from that frame. Thus they are a request of
+    their own.
+    """
+
+    PERSISTERS = [
+        MyBalanceSheet,
+        MyIncomeStatement,
+        MyCashFlowStatement,
+    ]
+
+    def __init__(self, symbols):
+        # a symbol, or a list of symbols to fetch in one go
+        self.stocks = get_stocks(symbols)
+
+    def get(self):
+        updated = set()
+        for symbol, df in financials_by_symbol(
+            self.stocks,
+            lambda s: s.get_financial_data(
+                STATEMENT_TYPES, frequency="q", trailing=False
+            ),
+            "statements",
+        ):
+            for persister in self.PERSISTERS:
+                persister.persist(self.stocks[symbol], df)
+            updated.add(symbol)
+
+        for symbol, df in financials_by_symbol(
+            self.stocks, lambda s: s.valuation_measures, "valuation_ratio"
+        ):
+            MyValuationRatio.persist(self.stocks[symbol], df)
+            updated.add(symbol)
+
+        for symbol in updated:
+            snapshot.refresh(self.stocks[symbol].id)
@@ -1,7 +1,11 @@
+import json
 import logging
 
-from stock.models import MyStock
-from yahooquery import Ticker
+import pandas as pd
+
+from fin import http_cache
+from stock.workers.batch import get_stocks
+from stock.workers.batch import get_ticker
 
 logger = logging.getLogger("stock")
 
@@ -9,56 +13,111 @@ logger = logging.getLogger("stock")
 NA = "No fundamentals data found"
 B = 10 ** 9
 
+# MyStock fields a summary sets
+FIELDS = [
+    "roa",
+    "roe",
+    "beta",
+    "top_ten_institution_ownership",
+    "shares_outstanding",
+    "profit_margin",
+    "institution_count",
+]
+
 
 class MySummary:
     """Some summary info we get from multiple sources."""
 
-    def __init__(self, symbol):
-        self.stock = MyStock.objects.get(symbol=symbol)
+    def __init__(self, symbols):
+        # a symbol, or a list of symbols to fetch in one go
+        self.stocks = get_stocks(symbols)
 
     def get(self):
-        s = Ticker(self.stock.symbol, timeout=15)
-
+        if not self.stocks:
+            return
+
+        s = get_ticker(self.stocks)
+
+        # Each module is one round of requests for all symbols, one
+        # per symbol, so read them once and then split by symbol.
+        data = {}
+        for module in ["financial_data", "key_stats", "major_holders"]:
+            data[module] = getattr(s, module)
+
+        # Raw module, not `institution_ownership`. That one concats
+        # frames of all symbols, and if any of them has no data, eg. a
+        # fund, we get an empty frame for all of them.
+        data["institution_ownership"] = s.get_modules(["institutionOwnership"])
+
+        for symbol, stock in self.stocks.items():
+            vals = [
+                data[x].get(symbol, NA)
+                for x in [
+                    "financial_data",
+                    "key_stats",
+                    "institution_ownership",
+                    "major_holders",
+                ]
+            ]
+
+            # same as what I persisted last time, nothing new
+            content = json.dumps(vals, sort_keys=True, default=str)
+            content_hash = http_cache.digest(content)
+            if http_cache.is_persisted("summary", symbol, content_hash):
+                logger.debug("[{}] summary unchanged".format(symbol))
+                continue
+
+            self.persist(stock, *vals)
+            http_cache.mark_persisted("summary", symbol, content_hash)
+
+    def persist(
+        self, stock, financial_data, key_stats, institution_ownership, holders
+    ):
         # https://yahooquery.dpguthrie.com/guide/ticker/modules/#financial_data
-        df = s.financial_data[self.stock.symbol]
+        df = financial_data
         if NA in df:
             logger.error(df)
         else:
-            self.stock.roa = df.get("returnOnAssets", 0) * 100
-            self.stock.roe = df.get("returnOnEquity", 0) * 100
+            stock.roa = df.get("returnOnAssets", 0) * 100
+            stock.roe = df.get("returnOnEquity", 0) * 100
 
         # https://yahooquery.dpguthrie.com/guide/ticker/modules/#key_stats
-        df = s.key_stats[self.stock.symbol]
+        df = key_stats
         if NA in df:
             logger.error(df)
         else:
             # BETA default to 5!
-            self.stock.beta = df.get("beta", 5)
+            stock.beta = df.get("beta", 5)
 
-            self.stock.top_ten_institution_ownership = df.get(
+            stock.top_ten_institution_ownership = df.get(
                 "heldPercentInstitutions", 0
             )
-            self.stock.shares_outstanding = df.get("sharesOutstanding", 0) / B
-            self.stock.profit_margin = df.get("profitMargins", 0) * 100
-
-        # This will either return a data frame (if a valid stock),
-        # or a dict (if a fund).
-        df = s.institution_ownership
-        msg = df.get(self.stock.symbol)
-        if msg is not None and NA in msg:
-            logger.error(df)
+            stock.shares_outstanding = df.get("sharesOutstanding", 0) / B
+            stock.profit_margin = df.get("profitMargins", 0) * 100
+
+        # https://yahooquery.dpguthrie.com/guide/ticker/modules/#institution_ownership
+        # Top owners of this symbol. Funds, eg., have none, then we
+        # get an error message instead.
+        owners = None
+        if isinstance(institution_ownership, dict):
+            owners = institution_ownership.get("ownershipList")
+        if not owners:
+            logger.error("{}: {}".format(stock.symbol, institution_ownership))
 
-        elif msg is None and not df.empty:
-            self.stock.top_ten_institution_ownership = (
+        else:
+            df = pd.DataFrame(owners)
+            stock.top_ten_institution_ownership = (
                 sum(df.get("pctHeld", 0)) * 100
             )
 
-        df = s.major_holders[self.stock.symbol]
+        df = holders
         if NA in df:
             logger.error(df)
 
         else:
-            self.stock.institution_count = df.get("institutionsCount", -1)
+            stock.institution_count = df.get("institutionsCount", -1)
 
-        # last, save the data
-        self.stock.save()
+        # last, save the data. Only my fields, since the stock was
+        # read before the batch, and the price worker may have
+        # updated others since.
+        stock.save(update_fields=FIELDS)
@@ -1,30 +1,26 @@
 import logging
 
-import pandas as pd
-
-from stock.models import MyStock
 from stock.models import ValuationRatio
-from yahooquery import Ticker
+from stock.workers.batch import financials_by_symbol
+from stock.workers.batch import get_stocks
+from stock.workers.batch import upsert_statements
 
 logger = logging.getLogger("stock")
 
 
 class MyValuationRatio:
-    def __init__(self, symbol):
-        self.stock = MyStock.objects.get(symbol=symbol)
+    def __init__(self, symbols):
+        # a symbol, or a list of symbols to fetch in one go
+        self.stocks = get_stocks(symbols)
 
     def get(self):
-        s = Ticker(self.stock.symbol, timeout=15)
-
-        # all numbers convert to million
-        df = s.valuation_measures
-        if "unavailable" in df or "error" in df:
-            logger.error("{}: {}".format(self.stock.symbol, df))
-            return
-
-        # DB doesn't like NaN
-        df = df.where(pd.notnull(df), 0)
+        for symbol, df in financials_by_symbol(
+            self.stocks, lambda s: s.valuation_measures, "valuation_ratio"
+        ):
+            self.persist(self.stocks[symbol], df)
 
+    @staticmethod
+    def persist(stock, df):
         mapping = {
             "forward_pe": "ForwardPeRatio",
             "pb": "PbRatio",
@@ -33,23 +29,9 @@ class MyValuationRatio:
             "ps": "PsRatio",
         }
 
-        # enumerate data frame
-        for row in df.itertuples(index=False):
-            i, created = ValuationRatio.objects.get_or_create(
-                stock=self.stock, on=row.asOfDate.date()
-            )
-
-            for key, val in mapping.items():
-                try:
-                    tmp = float(getattr(row, val))
-                except AttributeError:
-                    tmp = 0
-
-                # set value
-                setattr(i, key, tmp)
-            i.save()
+        upsert_statements(ValuationRatio, stock, df, mapping, scale=False)
 
         # if all values are 0, discard the record
         ValuationRatio.objects.filter(
-            forward_pe=0, pb=0, pe=0, peg=0, ps=0
+            stock=stock, forward_pe=0, pb=0, pe=0, peg=0, ps=0
         ).delete()
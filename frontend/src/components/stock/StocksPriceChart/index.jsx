@@ -8,7 +8,7 @@ import ShowResource from "src/components/common/ShowResource";
 export default function StocksPriceChart(props) {
   const { stocks: stock_ids, start, end } = props;
   const [resource] = useState(
-    `/historicals?stock__in=${stock_ids.join(",")}&on__range=${start},${end}`,
+    `/historicals?stock__in=${stock_ids.join(",")}&on__range=${start},${end}&fast=true`,
   );
 
   const render_data = (resp) => {
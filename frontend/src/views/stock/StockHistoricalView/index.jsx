@@ -18,7 +18,7 @@ function StockHistoricalView() {
   const { id } = useParams();
   const [start, setStart] = useState(get_last_month_string());
   const [end, setEnd] = useState(get_today_string());
-  const resource = `/historicals?stock=${id}&on__range=${start},${end}`;
+  const resource = `/historicals?stock=${id}&on__range=${start},${end}&fast=true`;
 
   const start_change = (event) => {
     const new_start = event.target.value;